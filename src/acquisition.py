@@ -0,0 +1,381 @@
+import time
+import struct
+import _thread
+from array import array
+from machine import RTC
+
+from ina3221 import INA3221, INA3221_ADDRS, INA3221_REG_MANUF_ID
+from i2cBus import I2CBus, I2C_FREQS
+from tools import datetime_to_iso_str
+from logger import log, log_warn, log_err
+from ioWorker import io_worker
+
+# États de la capture en rafale
+CAPTURE_IDLE = 'idle'
+CAPTURE_ARMED = 'armed'          # Remplit la fenêtre pré-trigger en boucle
+CAPTURE_TRIGGERED = 'triggered'  # Remplit la fenêtre post-trigger
+CAPTURE_SAVING = 'saving'        # Écriture du fichier en cours
+
+CAPTURE_MAGIC = b'BCAP'
+CAPTURE_VERSION = 1
+CAPTURE_MAX_SAMPLES = 4000
+
+# Erreurs I2C consécutives avant réinitialisation du bus, réinitialisations sans succès avant redémarrage
+ACQ_MAX_CONSECUTIVE_ERRORS = 20
+ACQ_MAX_RESETS = 5
+
+
+class Acquisition:
+    """
+    Gère un ou plusieurs INA3221 sur un même bus I2C.
+    - Les capteurs sont découverts via i2c.scan() parmi INA3221_ADDRS.
+    - Tous les capteurs sont lus en une seule passe, dans le thread appelant.
+    - Les mesures sont rangées dans une liste préallouée [v1, a1, v2, a2, ...],
+      3 canaux par capteur, dans l'ordre des adresses.
+    - Un échantillon en erreur I2C est perdu (missed_sample), la lecture continue.
+    """
+
+    def __init__(self, scl_pin=9, sda_pin=8, addrs=None, freqs=I2C_FREQS):
+        # Tous les capteurs partagent le même bus
+        self.bus = I2CBus(scl_pin=scl_pin, sda_pin=sda_pin, freqs=freqs)
+        self.missed = 0
+        self.consecutive_errors = 0
+        self.resets = 0
+        self.primary = INA3221(scl_pin=scl_pin, sda_pin=sda_pin, addr=INA3221_ADDRS[0], bus=self.bus)
+        self.devices = [self.primary]
+        self.discover(addrs)
+        # Fréquence la plus rapide supportée par tous les capteurs détectés
+        self.bus.negotiate([device.addr for device in self.devices], probe_reg=INA3221_REG_MANUF_ID)
+
+    @property
+    def i2c(self):
+        return self.bus.i2c
+
+    @property
+    def n_channels(self):
+        return 3 * len(self.devices)
+
+    def discover(self, addrs=None):
+        """Détecte les INA3221 présents (ou utilise addrs) et prépare les buffers de lecture."""
+        if addrs is None:
+            try:
+                found = self.i2c.scan()
+                addrs = [addr for addr in INA3221_ADDRS.values() if addr in found]
+            except Exception as e:
+                log_err(f"Erreur scan I2C: {e}")
+                addrs = []
+            if not addrs:
+                log_warn("Aucun INA3221 détecté, utilisation de l'adresse par défaut")
+                addrs = [INA3221_ADDRS[0]]
+
+        devices = []
+        for addr in addrs:
+            if addr == self.primary.addr:
+                devices.append(self.primary)
+            else:
+                devices.append(INA3221(scl_pin=self.primary.scl_pin, sda_pin=self.primary.sda_pin, addr=addr, bus=self.bus))
+        self.primary = devices[0]
+        self.devices = devices
+
+        self.raw = [array('H', [0] * 6) for _ in devices]
+        self.values = [0.0] * (2 * self.n_channels)
+        log(f"INA3221 détectés: {[hex(device.addr) for device in devices]}")
+        return self.devices
+
+    def read(self):
+        """Lit tous les capteurs et retourne la liste (réutilisée) [v1, a1, v2, a2, ...]."""
+        values = self.values
+        i = 0
+        for device, raw in zip(self.devices, self.raw):
+            device.read_all_channels(raw)
+            for channel in range(3):
+                values[i] = device.bus_voltage_from_raw(raw[channel * 2 + 1])
+                values[i + 1] = device.current_from_raw(channel, raw[channel * 2])
+                i += 2
+        return values
+
+    def get_global_current(self):
+        """Courant global du pack (somme shunt du premier capteur), None si la somme n'est pas active."""
+        if not self.primary.sum_channels:
+            return None
+        return self.primary.get_global_current()
+
+    def reset(self):
+        for device in self.devices:
+            device.reset()
+
+    def configure(self, **kwargs):
+        """Applique la même configuration à tous les capteurs, retourne celle du premier."""
+        config = None
+        for device in self.devices:
+            device_config = device.configure(**kwargs)
+            if config is None:
+                config = device_config
+        return config
+
+    def set_continuous(self):
+        for device in self.devices:
+            device.set_continuous()
+
+    def set_summation(self, channels=(1, 2, 3)):
+        for device in self.devices:
+            device.set_summation(channels)
+
+    def wait_conversion_ready(self, since_us=None):
+        # Les capteurs ont la même configuration : le premier donne la cadence
+        return self.primary.wait_conversion_ready(since_us=since_us)
+
+    def reset_i2c(self):
+        return self.bus.reset()
+
+    def sample_ok(self):
+        """Échantillon lu : fin d'une éventuelle série d'échecs."""
+        self.consecutive_errors = 0
+
+    def missed_sample(self, e):
+        """
+        Échantillon perdu sur OSError I2C (déjà comptée par le bus, qui descend sa fréquence).
+        Toutes les ACQ_MAX_CONSECUTIVE_ERRORS erreurs consécutives, le bus est réinitialisé.
+        Retourne True après ACQ_MAX_RESETS réinitialisations sans succès (redémarrage conseillé).
+        """
+        self.missed += 1
+        self.consecutive_errors += 1
+        if self.consecutive_errors % ACQ_MAX_CONSECUTIVE_ERRORS:
+            return False
+        self.resets += 1
+        log_err(f"Acquisition: {self.consecutive_errors} erreurs consécutives ({e}), réinitialisation du bus")
+        self.reset_i2c()
+        return self.consecutive_errors >= ACQ_MAX_CONSECUTIVE_ERRORS * ACQ_MAX_RESETS
+
+    def stats(self):
+        return {
+            'missed': self.missed,
+            'consecutiveErrors': self.consecutive_errors,
+            'resets': self.resets,
+        }
+
+
+class AdaptiveRate:
+    """
+    Décimation adaptative des mesures enregistrées.
+    - Les capteurs sont toujours lus à la fréquence d'acquisition.
+    - Si |dV/dt| ou |dI/dt| (depuis la dernière mesure enregistrée) dépasse
+      un seuil sur un canal, toutes les mesures sont enregistrées.
+    - Tant que le signal est plat, la décimation double tous les `hold`
+      enregistrements, jusqu'à max_decimation.
+    """
+
+    def __init__(self, dv_dt=0.01, di_dt=0.05, max_decimation=16, hold=10):
+        self.dv_dt = dv_dt  # V/s
+        self.di_dt = di_dt  # A/s
+        self.max_decimation = max_decimation
+        self.hold = hold
+        self.decimation = 1
+        self.rate = 0
+        self.counter = 0
+        self.flat_count = 0
+        self.last = None
+        self.last_us = 0
+
+    def update(self, values, now_us, freq):
+        """Retourne True si la mesure doit être enregistrée ; self.rate donne la fréquence effective."""
+        store = False
+        if self.last is None:
+            self.last = [0.0] * len(values)
+            store = True
+        else:
+            elapsed = time.ticks_diff(now_us, self.last_us) / 1000000
+            active = False
+            if elapsed > 0:
+                last = self.last
+                for i in range(0, len(values), 2):
+                    if abs(values[i] - last[i]) >= self.dv_dt * elapsed or abs(values[i + 1] - last[i + 1]) >= self.di_dt * elapsed:
+                        active = True
+                        break
+            self.counter += 1
+            if active:
+                self.decimation = 1
+                self.flat_count = 0
+                store = True
+            elif self.counter >= self.decimation:
+                store = True
+                self.flat_count += 1
+                if self.flat_count >= self.hold and self.decimation < self.max_decimation:
+                    self.decimation *= 2
+                    self.flat_count = 0
+
+        if store:
+            for i in range(len(values)):
+                self.last[i] = values[i]
+            self.last_us = now_us
+            self.counter = 0
+        self.rate = freq / self.decimation
+        return store
+
+    def stats(self):
+        return {
+            'decimation': self.decimation,
+            'rate': self.rate,
+            'dv_dt': self.dv_dt,
+            'di_dt': self.di_dt,
+        }
+
+
+class BurstCapture:
+    """
+    Capture en rafale d'une ou deux mesures (ex. 'a1', 'v1') sur déclenchement.
+    - Les échantillons sont lus aussi vite que le bus le permet pendant le
+      temps libre du thread capteur (entre deux échéances du Scheduler) :
+      le flux normal de DataHist n'est pas perturbé.
+    - Buffers array préalloués à l'armement : fenêtre circulaire pré-trigger
+      puis fenêtre post-trigger.
+    - Déclenchement sur seuil (|valeur| >= threshold) ou pente
+      (|delta| entre deux échantillons >= delta), sur la première mesure.
+    - Le résultat est écrit dans ./data/capture_<date>.bin par le thread d'écriture (IOWorker).
+
+    Format du fichier (little endian) :
+      header '<4sBBHH' : magic, version, nb mesures, nb échantillons, index du trigger
+      puis pour chaque mesure : nom (4 octets ascii, complété par des 0) et facteur d'échelle '<f' (unité / LSB)
+      puis les temps en µs relatifs au trigger ('<i' par échantillon)
+      puis les valeurs brutes ('<H' par mesure et par échantillon, entrelacées)
+    """
+
+    def __init__(self, acquisition, dir_path='./data'):
+        self.acquisition = acquisition
+        self.dir_path = dir_path
+        self.state = CAPTURE_IDLE
+        self.last_file = None
+        self.lock = _thread.allocate_lock()
+
+    @property
+    def active(self):
+        return self.state in (CAPTURE_ARMED, CAPTURE_TRIGGERED)
+
+    def _source(self, field):
+        """'a2' -> (capteur, registre shunt du canal 2, facteur d'échelle en A par LSB)."""
+        kind, number = field[0], int(field[1:])
+        if kind not in ('v', 'a') or not (1 <= number <= self.acquisition.n_channels):
+            raise ValueError(f"Invalid field: {field}")
+        device = self.acquisition.devices[(number - 1) // 3]
+        channel = (number - 1) % 3
+        if kind == 'a':
+            return device, 0x01 + channel * 2, device.current_from_raw(channel, 1)
+        return device, 0x02 + channel * 2, device.bus_voltage_from_raw(1)
+
+    def arm(self, fields=('a1',), pre=200, post=800, threshold=None, delta=None):
+        """
+        Arme une capture. threshold / delta sont exprimés dans l'unité de la
+        première mesure (A ou V). Lève ValueError si la capture est déjà en cours.
+        """
+        if threshold is None and delta is None:
+            raise ValueError("threshold or delta is required")
+        if not 1 <= len(fields) <= 2:
+            raise ValueError("1 or 2 fields expected")
+        if pre < 0 or post < 1 or pre + 1 + post > CAPTURE_MAX_SAMPLES:
+            raise ValueError(f"pre + post must be lower than {CAPTURE_MAX_SAMPLES}")
+
+        with self.lock:
+            if self.state != CAPTURE_IDLE:
+                raise ValueError(f"Capture already {self.state}")
+            self.fields = list(fields)
+            self.sources = [self._source(field) for field in fields]
+            scale = self.sources[0][2]
+            # Seuils convertis en valeurs brutes : pas de flottant dans la boucle rapide
+            self.threshold_raw = int(threshold / scale) if threshold is not None else None
+            self.delta_raw = int(delta / scale) if delta is not None else None
+            self.pre = pre
+            self.post = post
+            self.size = pre + 1 + post  # Fenêtre pré-trigger, échantillon du trigger, fenêtre post-trigger
+            self.n = len(fields)
+            self.raw = array('H', [0] * (self.size * self.n))
+            self.ticks = array('I', [0] * self.size)
+            self.index = 0
+            self.count = 0
+            self.remaining = post
+            self.trigger_index = None
+            self.prev = None
+            self.state = CAPTURE_ARMED
+        log(f"Capture armée: {self.fields} pre={pre} post={post} threshold={threshold} delta={delta}")
+
+    def cancel(self):
+        with self.lock:
+            if self.active:
+                self.state = CAPTURE_IDLE
+
+    def step(self):
+        """Lit un échantillon (appelé par le thread capteur pendant son temps libre)."""
+        if not self.active:
+            return
+        i = self.index
+        n = self.n
+        raw = self.raw
+        self.ticks[i] = time.ticks_us()
+        for k in range(n):
+            device, reg, _ = self.sources[k]
+            raw[i * n + k] = device.read_register(reg)
+
+        if self.state == CAPTURE_ARMED:
+            value = raw[i * n]
+            if value & 0x8000:
+                value -= 0x10000
+            triggered = self.threshold_raw is not None and abs(value) >= self.threshold_raw
+            if not triggered and self.delta_raw is not None and self.prev is not None:
+                triggered = abs(value - self.prev) >= self.delta_raw
+            self.prev = value
+            if triggered and self.count >= self.pre:
+                self.trigger_index = i
+                self.state = CAPTURE_TRIGGERED
+        else:
+            self.remaining -= 1
+
+        self.count += 1
+        self.index = (i + 1) % self.size
+        if self.state == CAPTURE_TRIGGERED and self.remaining == 0:
+            self.state = CAPTURE_SAVING
+            io_worker.submit('capture', self._thread_save, on_drop=self._save_dropped)
+
+    def _save_dropped(self):
+        """Job d'écriture refusé ou abandonné (file pleine) : capture perdue, retour en IDLE."""
+        log_err("❌ Capture abandonnée: file d'écriture pleine")
+        with self.lock:
+            self.state = CAPTURE_IDLE
+
+    def _thread_save(self):
+        """Écrit la capture dans l'ordre chronologique, puis repasse en IDLE."""
+        year, month, day, _, hour, minute, second, _ = RTC().datetime()
+        date_str = datetime_to_iso_str(year, month, day, hour, minute, second).replace(':', '-').rstrip('Z')
+        file_path = f"{self.dir_path}/capture_{date_str}.bin"
+        size = self.size
+        n = self.n
+        # Après la fenêtre post-trigger, l'index courant pointe sur l'échantillon le plus ancien
+        start = self.index
+        trigger_tick = self.ticks[self.trigger_index]
+        try:
+            with open(file_path, 'wb') as f:
+                f.write(struct.pack('<4sBBHH', CAPTURE_MAGIC, CAPTURE_VERSION, n, size, (self.trigger_index - start) % size))
+                for field, (_, _, scale) in zip(self.fields, self.sources):
+                    f.write(struct.pack('<4sf', field.encode(), scale))
+                times = array('i', [0] * size)
+                values = array('H', [0] * (size * n))
+                for j in range(size):
+                    src = (start + j) % size
+                    times[j] = time.ticks_diff(self.ticks[src], trigger_tick)
+                    for k in range(n):
+                        values[j * n + k] = self.raw[src * n + k]
+                f.write(times)
+                f.write(values)
+            self.last_file = file_path
+            log(f"✅ Capture sauvegardée → {file_path}")
+        except Exception as e:
+            log_err(f"❌ Erreur sauvegarde capture: {e}")
+        self.state = CAPTURE_IDLE
+
+    def status(self):
+        return {
+            'state': self.state,
+            'fields': getattr(self, 'fields', []),
+            'pre': getattr(self, 'pre', 0),
+            'post': getattr(self, 'post', 0),
+            'samples': getattr(self, 'count', 0),
+            'lastFile': self.last_file,
+        }
@@ -0,0 +1,564 @@
+import os
+import time
+import struct
+import binascii
+
+from tools import epoch_ms_to_datetime, datetime_to_iso_str
+from logger import log, log_warn, log_err
+
+# En-tête : magic, version, nombre de canaux, période d'un enregistrement (s), début du jour (ms depuis 1970),
+# taille d'un enregistrement, enregistrements par bloc
+AGGREGATE_MAGIC = b'DAG1'
+AGGREGATE_VERSION = 1
+AGGREGATE_HEADER = '<4sBBHqHH'
+AGGREGATE_HEADER_SIZE = struct.calcsize(AGGREGATE_HEADER)
+AGGREGATE_PERIOD_S = 60
+AGGREGATE_BLOCK_S = 3600  # Un bloc (avec son crc32) par heure
+DAY_MS = 86400000
+AGGREGATE_SUFFIX = '_daily_1_minute_aggregate'
+
+# Index clairsemé (fichier voisin '<fichier>.idx') : magic, version, réservé, nombre d'entrées,
+# puis une entrée par heure : offset de la première ligne, nombre de lignes
+INDEX_MAGIC = b'DIX1'
+INDEX_VERSION = 1
+INDEX_HEADER = '<4sBBH'
+INDEX_HEADER_SIZE = struct.calcsize(INDEX_HEADER)
+INDEX_ENTRY = '<IH'
+INDEX_ENTRY_SIZE = struct.calcsize(INDEX_ENTRY)
+INDEX_ENTRIES = 86400 // AGGREGATE_BLOCK_S
+INDEX_SUFFIX = '.idx'
+
+# Politiques de synchronisation flash (flush) de AggregateWriter
+FSYNC_BATCH = 'batch'  # À chaque lot de lignes écrit
+FSYNC_HOUR = 'hour'    # À la fin de chaque bloc d'une heure
+FSYNC_NONE = 'none'    # À la fermeture du fichier (changement de jour) uniquement
+FSYNC_POLICIES = (FSYNC_BATCH, FSYNC_HOUR, FSYNC_NONE)
+
+
+def aggregate_file_name(year, month, day, ext='bin'):
+    return f"{year:04d}-{month:02d}-{day:02d}{AGGREGATE_SUFFIX}.{ext}"
+
+
+def day_start_ms(timestamp_ms):
+    """Début du jour (minuit) contenant timestamp_ms, en ms depuis 1970."""
+    return timestamp_ms - timestamp_ms % DAY_MS
+
+
+def aggregate_columns(n_channels):
+    """Noms des colonnes CSV des agrégats, après la date : avg_v1, avg_a1, ws1, ..., avg_a."""
+    columns = []
+    for channel in range(1, n_channels + 1):
+        columns += [f"avg_v{channel}", f"avg_a{channel}", f"ws{channel}"]
+    return columns + ['avg_a']
+
+
+def record_format(n_channels):
+    """Enregistrement : nombre de mesures, [avg_v1, avg_a1, ..., avg_a], [ws1, ..., wsN]."""
+    return '<I' + 'f' * (2 * n_channels + 1) + 'f' * n_channels
+
+
+class AggregateIndex:
+    """
+    Index clairsemé d'un fichier journalier : pour chaque heure, l'offset en octets
+    de sa première ligne et son nombre de lignes (0 = heure vide). Les entrées ont
+    une taille fixe : la mise à jour d'une heure est une seule écriture en place.
+    Une lecture de plage coûte un seek, sans parcourir les heures précédentes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = [0] * INDEX_ENTRIES
+        self.rows = [0] * INDEX_ENTRIES
+        self.file = None
+
+    @staticmethod
+    def load(path):
+        """Index existant, None s'il est absent ou invalide."""
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return None
+        if len(raw) != INDEX_HEADER_SIZE + INDEX_ENTRIES * INDEX_ENTRY_SIZE:
+            return None
+        magic, version, _, entries = struct.unpack_from(INDEX_HEADER, raw)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or entries != INDEX_ENTRIES:
+            return None
+        index = AggregateIndex(path)
+        for hour in range(INDEX_ENTRIES):
+            index.offsets[hour], index.rows[hour] = struct.unpack_from(INDEX_ENTRY, raw, INDEX_HEADER_SIZE + hour * INDEX_ENTRY_SIZE)
+        return index
+
+    def save(self):
+        """Écrit l'index complet, gardé ouvert pour les mises à jour suivantes. Retourne les octets écrits."""
+        self.close()
+        self.file = open(self.path, 'w+b')
+        self.file.write(struct.pack(INDEX_HEADER, INDEX_MAGIC, INDEX_VERSION, 0, INDEX_ENTRIES))
+        for hour in range(INDEX_ENTRIES):
+            self.file.write(struct.pack(INDEX_ENTRY, self.offsets[hour], self.rows[hour]))
+        return INDEX_HEADER_SIZE + INDEX_ENTRIES * INDEX_ENTRY_SIZE
+
+    def set(self, hour, offset, rows):
+        """Met à jour l'entrée de l'heure (réécrite en place si l'index est ouvert). Retourne les octets écrits."""
+        if self.offsets[hour] == offset and self.rows[hour] == rows:
+            return 0
+        self.offsets[hour] = offset
+        self.rows[hour] = rows
+        if self.file is None:
+            return 0
+        self.file.seek(INDEX_HEADER_SIZE + hour * INDEX_ENTRY_SIZE)
+        self.file.write(struct.pack(INDEX_ENTRY, offset, rows))
+        return INDEX_ENTRY_SIZE
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def find(self, hour):
+        """(heure, offset) de la première heure non vide à partir de hour, None s'il n'y en a pas."""
+        for h in range(max(0, hour), INDEX_ENTRIES):
+            if self.rows[h] > 0:
+                return h, self.offsets[h]
+        return None
+
+
+def index_text_file(path):
+    """Index d'un ancien fichier texte (CSV non compressé), construit en un parcours."""
+    index = AggregateIndex(path + INDEX_SUFFIX)
+    with open(path, 'rb') as f:
+        f.readline()  # En-tête
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            if len(line) < 16:
+                continue
+            hour = int(line[11:13])
+            if index.rows[hour] == 0:
+                index.offsets[hour] = offset
+            index.rows[hour] += 1
+    return index
+
+
+def rebuild_indexes(dir_path='./data'):
+    """
+    Outil (REPL) : reconstruit l'index des fichiers journaliers existants de dir_path
+    (binaires et anciens fichiers texte non compressés) et supprime les index orphelins.
+        >>> import aggregates; aggregates.rebuild_indexes()
+    Retourne le nombre d'index écrits.
+    """
+    names = os.listdir(dir_path)
+    built = 0
+    for name in names:
+        path = f"{dir_path}/{name}"
+        try:
+            if name.endswith(INDEX_SUFFIX):
+                if name[:-len(INDEX_SUFFIX)] not in names:
+                    os.remove(path)
+                    log(f"✅ Index orphelin supprimé : {name}")
+                continue
+            if name.endswith(f'{AGGREGATE_SUFFIX}.bin'):
+                index = AggregateFile.load(path).build_index()
+            elif name.endswith(f'{AGGREGATE_SUFFIX}.txt'):
+                index = index_text_file(path)
+            else:
+                continue
+            index.save()
+            index.close()
+            built += 1
+            log(f"✅ Index reconstruit : {index.path} ({sum(index.rows)} lignes)")
+        except Exception as e:
+            log_err(f"Index : erreur pour {name} : {e}")
+    return built
+
+
+class AggregateFile:
+    """
+    Fichier binaire des agrégats d'un jour : en-tête puis un enregistrement de
+    taille fixe par minute (slot), regroupés en blocs d'une heure suivis du
+    crc32 du bloc. Le slot N (minute N du jour) est à un offset calculable :
+    lecture et écriture directes, sans parcourir le fichier. Un slot vide
+    (minute sans mesure) est à zéro, son nombre de mesures vaut 0.
+    L'index voisin (AggregateIndex), tenu à jour à chaque flush(), donne les
+    heures non vides sans lire leurs blocs.
+    """
+
+    def __init__(self, path, n_channels, day_ms, period_s=AGGREGATE_PERIOD_S):
+        self.path = path
+        self.n_channels = n_channels
+        self.day_ms = day_ms
+        self.period_s = period_s
+        self.record_format = record_format(n_channels)
+        self.record_size = struct.calcsize(self.record_format)
+        self.block_records = AGGREGATE_BLOCK_S // period_s
+        self.block_size = self.block_records * self.record_size + 4
+        self.slots = 86400 // period_s
+        self.file = None
+        self.index = None
+        # Bloc en cours d'écriture, gardé en RAM pour recalculer son crc32
+        self.block = None
+        self.block_buf = bytearray(self.block_records * self.record_size)
+        # Slots [dirty_from, dirty_to) du bloc modifiés depuis le dernier flush()
+        self.dirty_from = None
+        self.dirty_to = 0
+
+    @staticmethod
+    def load(path):
+        """Ouvre un fichier existant en lecture (paramètres lus dans l'en-tête)."""
+        with open(path, 'rb') as f:
+            header = f.read(AGGREGATE_HEADER_SIZE)
+        if len(header) != AGGREGATE_HEADER_SIZE:
+            raise ValueError(f"Invalid aggregate file: {path}")
+        magic, version, n, period_s, day_ms, record_size, block_records = struct.unpack(AGGREGATE_HEADER, header)
+        if magic != AGGREGATE_MAGIC or version != AGGREGATE_VERSION:
+            raise ValueError(f"Invalid aggregate file: {path}")
+        aggregate = AggregateFile(path, n, day_ms, period_s)
+        if aggregate.record_size != record_size or aggregate.block_records != block_records:
+            raise ValueError(f"Invalid aggregate file: {path} - unexpected record layout")
+        return aggregate
+
+    def _header(self):
+        return struct.pack(AGGREGATE_HEADER, AGGREGATE_MAGIC, AGGREGATE_VERSION, self.n_channels,
+                           self.period_s, self.day_ms, self.record_size, self.block_records)
+
+    def _offset(self, slot):
+        block, k = divmod(slot, self.block_records)
+        return AGGREGATE_HEADER_SIZE + block * self.block_size + k * self.record_size
+
+    def slot(self, timestamp_ms):
+        """Slot de l'enregistrement contenant timestamp_ms."""
+        slot = (timestamp_ms - self.day_ms) // (self.period_s * 1000)
+        if not 0 <= slot < self.slots:
+            raise ValueError(f"Timestamp {timestamp_ms} outside of {self.path}")
+        return slot
+
+    def _open_write(self, exists=None):
+        """
+        Ouvre le fichier en écriture, en le créant avec son en-tête s'il n'existe pas
+        (exists : existence déjà connue, None = essayer d'ouvrir). Retourne les octets écrits.
+        """
+        f = None
+        if exists is not False:
+            try:
+                f = open(self.path, 'r+b')
+            except OSError:
+                f = None
+        if f is None:
+            self.file = open(self.path, 'w+b')
+            self.file.write(self._header())
+            self.index = AggregateIndex(self.path + INDEX_SUFFIX)
+            return AGGREGATE_HEADER_SIZE + self.index.save()
+        header = f.read(AGGREGATE_HEADER_SIZE)
+        if header != self._header():
+            # Autre nombre de canaux (capteur ajouté ou retiré) ou fichier corrompu :
+            # l'ancien fichier est mis de côté, le jour continue dans un nouveau fichier
+            f.close()
+            self._move_aside(header)
+            return self._open_write(exists=False)
+        self.file = f
+        # Fichier repris (redémarrage) : index reconstruit, il a pu ne pas suivre la dernière écriture
+        self.index = self.build_index()
+        return self.index.save()
+
+    def _move_aside(self, header):
+        """
+        Renomme le fichier (et son index) en 'YYYY-MM-DD_<n>ch_daily_1_minute_aggregate.bin'
+        (n : canaux de son en-tête, 'old' s'il est illisible), toujours lu par l'historique.
+        """
+        n = None
+        if len(header) == AGGREGATE_HEADER_SIZE and header[:4] == AGGREGATE_MAGIC:
+            n = struct.unpack(AGGREGATE_HEADER, header)[2]
+        directory, name = self.path.rsplit('/', 1)
+        tag = f"{n}ch" if n is not None else 'old'
+        names = os.listdir(directory)
+        k = 1
+        aside = f"{name[:10]}_{tag}{name[10:]}"
+        while aside in names:
+            k += 1
+            aside = f"{name[:10]}_{tag}-{k}{name[10:]}"
+        os.rename(self.path, f"{directory}/{aside}")
+        if name + INDEX_SUFFIX in names:
+            os.rename(self.path + INDEX_SUFFIX, f"{directory}/{aside}{INDEX_SUFFIX}")
+        log_warn(f"Agrégats : {name} ne correspond pas à {self.n_channels} canaux, renommé en {aside}")
+
+    def _load_block(self, block):
+        """Charge le bloc depuis le fichier (slots déjà écrits avant un redémarrage), zéros sinon."""
+        buf = self.block_buf
+        for k in range(len(buf)):
+            buf[k] = 0
+        self.file.seek(AGGREGATE_HEADER_SIZE + block * self.block_size)
+        self.file.readinto(buf)
+        self.block = block
+
+    def put(self, slot, length, avgs, ws):
+        """
+        Range l'enregistrement du slot dans le bloc en RAM, écrit sur la flash par flush().
+        Le bloc précédent est écrit (sans synchronisation) si le slot est dans un autre bloc.
+        Retourne les octets écrits.
+        """
+        written = 0
+        if self.file is None:
+            written += self._open_write()
+        block, k = divmod(slot, self.block_records)
+        if block != self.block:
+            written += self.flush(sync=False)
+            self._load_block(block)
+        struct.pack_into(self.record_format, self.block_buf, k * self.record_size, length, *(list(avgs) + list(ws)))
+        if self.dirty_from is None or k < self.dirty_from:
+            self.dirty_from = k
+        if k + 1 > self.dirty_to:
+            self.dirty_to = k + 1
+        return written
+
+    def flush(self, sync=True):
+        """Écrit les enregistrements modifiés du bloc puis son crc32. Retourne les octets écrits."""
+        if self.dirty_from is None:
+            return 0
+        start = self.dirty_from * self.record_size
+        end = self.dirty_to * self.record_size
+        block_offset = AGGREGATE_HEADER_SIZE + self.block * self.block_size
+        f = self.file
+        f.seek(block_offset + start)
+        f.write(memoryview(self.block_buf)[start:end])
+        f.seek(block_offset + len(self.block_buf))
+        f.write(struct.pack('<I', binascii.crc32(self.block_buf)))
+        written = end - start + 4
+        if self.index is not None:
+            rows = 0
+            for k in range(self.block_records):
+                if struct.unpack_from('<I', self.block_buf, k * self.record_size)[0]:
+                    rows += 1
+            written += self.index.set(self.block, block_offset, rows)
+        if sync:
+            self.sync()
+        self.dirty_from = None
+        self.dirty_to = 0
+        return written
+
+    def sync(self):
+        """Synchronise le fichier et son index sur la flash."""
+        self.file.flush()
+        if self.index is not None:
+            self.index.flush()
+
+    def write(self, slot, length, avgs, ws):
+        """Écrit directement l'enregistrement du slot et le crc32 de son bloc. Retourne les octets écrits."""
+        return self.put(slot, length, avgs, ws) + self.flush()
+
+    def close(self):
+        """Écrit les enregistrements en attente puis ferme le fichier. Retourne les octets écrits."""
+        written = 0
+        if self.file is not None:
+            written = self.flush()
+            self.file.close()
+            self.file = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        self.block = None
+        return written
+
+    def read(self, slot):
+        """(length, avgs, ws) du slot, None si vide (bloc non vérifié : accès direct)."""
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset(slot))
+            raw = f.read(self.record_size)
+        if len(raw) != self.record_size:
+            return None
+        return self._unpack(raw, 0)
+
+    def _unpack(self, buf, offset):
+        values = struct.unpack_from(self.record_format, buf, offset)
+        if values[0] == 0:
+            return None
+        n = self.n_channels
+        return values[0], values[1:2 * n + 2], values[2 * n + 2:]
+
+    def build_index(self):
+        """Index (AggregateIndex) reconstruit depuis les blocs valides du fichier."""
+        index = AggregateIndex(self.path + INDEX_SUFFIX)
+        for block in range(INDEX_ENTRIES):
+            index.offsets[block] = AGGREGATE_HEADER_SIZE + block * self.block_size
+        period_ms = self.period_s * 1000
+        for row in self.rows():
+            index.rows[(row[0] - self.day_ms) // period_ms // self.block_records] += 1
+        return index
+
+    def rows(self, from_slot=0, to_slot=None, index=None):
+        """
+        Générateur des enregistrements non vides (minute_ms, length, avgs, ws) des slots
+        [from_slot, to_slot), bloc par bloc : un seul bloc en RAM. Les blocs dont le
+        crc32 est invalide sont ignorés, ainsi que les heures vides selon index.
+        """
+        if to_slot is None:
+            to_slot = self.slots
+        buf = bytearray(self.block_size)
+        period_ms = self.period_s * 1000
+        with open(self.path, 'rb') as f:
+            for block in range(from_slot // self.block_records, (to_slot - 1) // self.block_records + 1):
+                if index is not None and index.rows[block] == 0:
+                    continue
+                f.seek(AGGREGATE_HEADER_SIZE + block * self.block_size)
+                size = f.readinto(buf)
+                if not size:
+                    break
+                records = len(buf) - 4
+                if size != len(buf):
+                    # Dernier bloc sans crc32 (écriture interrompue) : ignoré
+                    continue
+                crc = struct.unpack_from('<I', buf, records)[0]
+                if crc != binascii.crc32(memoryview(buf)[:records]):
+                    if crc != 0 or any(buf):
+                        log_warn(f"Agrégats : bloc {block} invalide dans {self.path}")
+                    # Bloc à zéro : heure sans mesure
+                    continue
+                for k in range(self.block_records):
+                    slot = block * self.block_records + k
+                    if slot < from_slot or slot >= to_slot:
+                        continue
+                    row = self._unpack(buf, k * self.record_size)
+                    if row is not None:
+                        yield (self.day_ms + slot * period_ms,) + row
+
+    def csv_header(self):
+        return "date;" + ";".join(aggregate_columns(self.n_channels)) + "\n"
+
+    def csv(self):
+        """Générateur CSV (même format que les anciens fichiers texte), ligne par ligne."""
+        yield self.csv_header()
+        n = self.n_channels
+        for minute_ms, length, avgs, ws in self.rows():
+            year, month, day, hour, minute = epoch_ms_to_datetime(minute_ms)[:5]
+            line = datetime_to_iso_str(year, month, day, hour, minute, 0)
+            for channel in range(n):
+                line += f";{avgs[2 * channel]:.3f};{avgs[2 * channel + 1]:.3f};{ws[channel]:.4f}"
+            yield line + f";{avgs[2 * n]:.3f}\n"
+
+
+class AggregateWriter:
+    """
+    Écriture des agrégats d'une minute dans les fichiers du jour (thread d'écriture uniquement).
+    - Un seul listdir au premier appel ; l'existence des fichiers est ensuite suivie en RAM.
+    - Le fichier du jour reste ouvert, fermé au changement de jour.
+    - Les lignes sont rangées dans le bloc de l'heure en RAM et écrites par lots
+      de batch_rows (une écriture + un crc32 par lot).
+    - fsync : synchronisation flash à chaque lot ('batch'), à chaque fin d'heure
+      ('hour') ou à la fermeture du fichier seulement ('none'). Les lignes non
+      écrites ou non synchronisées sont perdues sur coupure.
+    """
+
+    def __init__(self, dir_path, n_channels, batch_rows=10, fsync=FSYNC_BATCH):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Invalid fsync policy: {fsync} - expected one of {FSYNC_POLICIES}")
+        self.dir_path = dir_path
+        self.n_channels = n_channels
+        self.batch_rows = max(1, batch_rows)
+        self.fsync = fsync
+        self.known = None       # Noms des fichiers de dir_path (listdir au premier appel)
+        self.current = None     # AggregateFile du jour, ouvert
+        self.pending = 0        # Lignes rangées en RAM, pas encore écrites
+        self.unsynced = False   # Lignes écrites, pas encore synchronisées
+        # Statistiques
+        self.rows = 0
+        self.batches = 0
+        self.syncs = 0
+        self.bytes = 0
+        self.hour_block = None  # Bloc (heure) en cours et octets écrits pour lui
+        self.hour_bytes = 0
+        self.last_hour_bytes = 0
+        self.started = None     # time.time() de la première écriture
+
+    def _exists(self, name):
+        if self.known is None:
+            try:
+                self.known = set(os.listdir(self.dir_path))
+            except OSError:
+                self.known = set()
+        return name in self.known
+
+    def _written(self, size):
+        self.bytes += size
+        self.hour_bytes += size
+
+    def _open(self, day_ms):
+        year, month, day = epoch_ms_to_datetime(day_ms)[:3]
+        name = aggregate_file_name(year, month, day)
+        aggregate = AggregateFile(f"{self.dir_path}/{name}", self.n_channels, day_ms)
+        self._written(aggregate._open_write(self._exists(name)))
+        self.known.add(name)
+        self.current = aggregate
+
+    def _flush(self, end_of_hour=False):
+        """Écrit le lot en attente puis synchronise selon la politique fsync."""
+        current = self.current
+        if current.dirty_from is not None:
+            self._written(current.flush(sync=False))
+            self.batches += 1
+            self.unsynced = True
+            log(f"✅ Sauvegardé {self.pending} minutes → {current.path}")
+        if self.unsynced and (self.fsync == FSYNC_BATCH or (self.fsync == FSYNC_HOUR and end_of_hour)):
+            current.sync()
+            self.syncs += 1
+            self.unsynced = False
+        self.pending = 0
+
+    def write(self, row):
+        """Ajoute la ligne (minute_ms, length, avgs, ws) d'une minute terminée (voir MinuteAccumulator.row)."""
+        minute_ms, length, avgs, ws = row
+        if length == 0:
+            return
+        if self.started is None:
+            self.started = time.time()
+        day_ms = day_start_ms(minute_ms)
+        if self.current is None or self.current.day_ms != day_ms:
+            self.close()
+            self._open(day_ms)
+        current = self.current
+        slot = current.slot(minute_ms)
+        block = slot // current.block_records
+        if block != self.hour_block:
+            # Heure terminée : bloc écrit, octets de l'heure comptés
+            if current.block is not None:
+                self._flush(end_of_hour=True)
+            if self.hour_block is not None:
+                self.last_hour_bytes = self.hour_bytes
+            self.hour_block = block
+            self.hour_bytes = 0
+        self._written(current.put(slot, length, avgs, ws))
+        self.rows += 1
+        self.pending += 1
+        if self.pending >= self.batch_rows:
+            self._flush()
+
+    def close(self):
+        """Écrit les lignes en attente et ferme le fichier du jour (synchronisé)."""
+        if self.current is not None:
+            try:
+                self._flush(end_of_hour=True)
+                self._written(self.current.close())
+                self.unsynced = False
+            except Exception as e:
+                log_err(f"Agrégats : erreur à la fermeture de {self.current.path} : {e}")
+            self.current = None
+
+    def stats(self):
+        elapsed_h = (time.time() - self.started) / 3600 if self.started is not None else 0
+        current = self.current  # Copie locale : close() peut le remettre à None (thread d'écriture)
+        return {
+            'file': current.path if current is not None else None,
+            'batchRows': self.batch_rows,
+            'fsync': self.fsync,
+            'pending': self.pending,
+            'rows': self.rows,
+            'batches': self.batches,
+            'syncs': self.syncs,
+            'bytes': self.bytes,
+            'bytesLastHour': self.last_hour_bytes,
+            'bytesPerHour': int(self.bytes / elapsed_h) if elapsed_h > 0 else None,
+        }
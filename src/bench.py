@@ -0,0 +1,172 @@
+import gc
+import os
+import time
+import _thread
+from array import array
+
+from logger import log
+
+
+def _alloc_per_call(fn, count):
+    """Retourne (octets alloués par appel, µs par appel) en mesurant le delta gc.mem_alloc."""
+    fn()  # Premier appel hors mesure (caches, interned strings...)
+    gc.collect()
+    gc.disable()
+    try:
+        start_alloc = gc.mem_alloc()
+        start = time.ticks_us()
+        for _ in range(count):
+            fn()
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        allocated = gc.mem_alloc() - start_alloc
+    finally:
+        gc.enable()
+    return allocated / count, elapsed / count
+
+
+def bench_ina_alloc(ina, count=100):
+    """
+    Compare les allocations par échantillon (6 mesures) des différents
+    chemins de lecture INA3221.
+    Usage (REPL) : import bench; bench.bench_ina_alloc(main.acq.primary)
+    """
+    raw = array('H', [0] * 6)
+
+    def legacy_sample():
+        for channel in range(3):
+            ina.get_bus_voltage(channel)
+            ina.get_current(channel)
+
+    def register_sample():
+        for reg in range(1, 7):
+            ina._read_register(reg)
+
+    def burst_sample():
+        ina.read_all_channels(raw)
+
+    results = {}
+    for name, fn in (('legacy', legacy_sample), ('register', register_sample), ('burst', burst_sample)):
+        alloc, duration = _alloc_per_call(fn, count)
+        results[name] = {'bytes_per_sample': alloc, 'us_per_sample': duration}
+        log(f"bench ina3221 {name}: {alloc:.1f} octets/échantillon - {duration:.0f} µs/échantillon", tag="BENCH")
+    return results
+
+
+def bench_add_jitter(n_channels=3, freq=50, duration_s=10, max_size=2000):
+    """
+    Jitter d'acquisition (durée de DataHist.add et retard du Scheduler) pendant
+    qu'un lecteur lit l'historique en boucle, comme un client sur /api/data :
+    - 'idle' : sans lecteur
+    - 'seqlock' : DataHist.between() (bornes sous verrou, sérialisation hors verrou)
+    - 'locked' : sérialisation complète sous data.lock (ancien comportement)
+    Les valeurs de 'seqlock' doivent rester proches de 'idle'.
+    Usage (REPL) : import bench; bench.bench_add_jitter()
+    """
+    from dataHist import DataHist
+    from scheduler import Scheduler
+
+    # Fichiers journaliers / journal du bench à part des vraies données
+    data = DataHist(max_size=max_size, load_backup=False, n_channels=n_channels, dir_path='./data/bench')
+    values = [1.0] * (2 * n_channels)
+    for _ in range(max_size):
+        data.add(values, 1.0, freq)
+
+    def locked_read():
+        with data.lock:
+            return [data.json(data._entry(data._index(k))) for k in range(data.count)]
+
+    state = {'run': False, 'reads': 0}
+
+    def reader(read):
+        while state['run']:
+            read()
+            state['reads'] += 1
+        state['done'] = True
+
+    results = {}
+    for name, read in (('idle', None), ('seqlock', data.between), ('locked', locked_read)):
+        state['run'] = read is not None
+        state['reads'] = 0
+        state['done'] = read is None
+        if read is not None:
+            _thread.start_new_thread(reader, (read,))
+
+        scheduler = Scheduler(freq=freq)
+        add_max_us = 0
+        add_sum_us = 0
+        count = freq * duration_s
+        scheduler.start()
+        for _ in range(count):
+            scheduler.wait()
+            start = time.ticks_us()
+            data.add(values, 1.0, freq)
+            duration = time.ticks_diff(time.ticks_us(), start)
+            add_sum_us += duration
+            if duration > add_max_us:
+                add_max_us = duration
+
+        state['run'] = False
+        while not state['done']:
+            time.sleep_ms(10)
+        stats = scheduler.stats()
+        results[name] = {
+            'reads': state['reads'],
+            'add.max_us': add_max_us,
+            'add.avg_us': add_sum_us // count,
+            'jitter.max_us': stats['jitter.max_us'],
+            'jitter.avg_us': stats['jitter.avg_us'],
+            'overruns': stats['overruns'],
+        }
+        log(f"bench add {name}: {state['reads']} lectures - add max {add_max_us} µs / moy {add_sum_us // count} µs - jitter max {stats['jitter.max_us']} µs", tag="BENCH")
+    return results
+
+
+def bench_boot_restore(size=1000, n_channels=3):
+    """
+    Durée de restauration au démarrage de size mesures : ancien backup texte
+    (une ligne par mesure, parse_iso_date_str + map(float)) contre snapshot
+    binaire du journal lu avec readinto directement dans les arrays.
+    Usage (REPL) : import bench; bench.bench_boot_restore()
+    """
+    from dataHist import DataHist
+    from tools import get_timestamp_from_rtc_datetime, epoch_ms_to_iso_str
+
+    dir_path = './data/bench'
+    now_ms = get_timestamp_from_rtc_datetime()
+    source = DataHist(max_size=size, load_backup=False, n_channels=n_channels, dir_path=dir_path, journal_records=size)
+    entry = [0.0] * (len(source.fields) + 1)
+    with source.lock:
+        for k in range(size):
+            entry[0] = now_ms - (size - k) * 1000
+            for field in range(1, len(entry)):
+                entry[field] = k + field / 10
+            source._push_entry(entry)
+
+    # Ancien format texte, de la plus récente à la plus ancienne
+    with open(source.backup_file_path, 'w') as f:
+        for entry in source.snapshot():
+            f.write(epoch_ms_to_iso_str(entry[0]) + ''.join(f";{value:.3f}" for value in entry[1:]) + "\n")
+    # Snapshot binaire (compaction du journal)
+    source.journal.compact(lambda f: source._write_snapshot(f, source.seq))
+    source.journal.file.close()
+
+    results = {}
+    for name in ('text', 'binary'):
+        target = DataHist(max_size=size, load_backup=False, n_channels=n_channels, dir_path=dir_path, journal_records=size)
+        gc.collect()
+        start = time.ticks_us()
+        if name == 'text':
+            target._load_text_backup(now_ms)
+        else:
+            target.journal.recover(lambda f, count, skip, crc, end_seq: target._load_snapshot(f, count, skip, crc, end_seq, now_ms), target._push_entry)
+            target.journal.file.close()
+        duration = time.ticks_diff(time.ticks_us(), start)
+        results[name] = {'count': target.count, 'ms': duration / 1000}
+        log(f"bench boot {name}: {target.count} mesures en {duration / 1000:.1f} ms", tag="BENCH")
+
+    for path in [source.backup_file_path] + list(source.journal.paths.values()):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return results
@@ -1,188 +1,681 @@
-import time
 from machine import RTC
 import os
+import gc
+import struct
 import _thread
+from array import array
 
-from tools import is_date_after, is_valid_date, datetime_to_iso_str, parse_iso_date_str
-from env import env
+from tools import parse_iso_date_str, datetime_to_epoch_ms, epoch_ms_to_iso_str
 from logger import log, log_warn, log_err
+from ioWorker import io_worker
+from journal import Journal, BLOCK_MAX_RECORDS, JOURNAL_DEFAULT_RECORDS, write_columns, read_columns
+from aggregates import AggregateWriter, FSYNC_BATCH
 
-class DataHist:
-    def __init__(self, max_size=1000, load_backup=True):
-        """Initialiser l'historique des données."""
+def _alloc_array(typecode, size):
+    """
+    Array préalloué de `size` zéros, en une seule allocation (copie d'octets à zéro) :
+    pas d'agrandissement progressif ni de fragmentation du tas pour les grands buffers.
+    """
+    return array(typecode, bytes(size * struct.calcsize(typecode)))
+
+class TimeRing:
+    """
+    Buffer circulaire ordonné dans le temps : timestamps en ms depuis 1970
+    (array 'q' préalloué), tête d'écriture et nombre d'éléments. Les colonnes
+    de valeurs sont gérées par les classes filles.
+    Chaque élément a un numéro de séquence croissant (seq), rangé à l'index
+    seq % max_size : les lecteurs prennent les bornes sous self.lock puis
+    copient hors verrou et écartent les éléments écrasés entre-temps (seqlock).
+    """
+
+    def __init__(self, max_size):
         self.max_size = max_size
-        self.data = []  # Liste pour stocker les mesures
+        self.timestamps = _alloc_array('q', max_size)
+        self.head = 0   # Index de la prochaine écriture (= seq % max_size)
+        self.count = 0  # Nombre d'éléments stockés (<= max_size)
+        self.seq = 0    # Numéro de séquence du prochain élément (nombre d'éléments écrits)
+
+    def _claim(self):
+        """
+        Réserve l'index du prochain élément, à écrire ensuite sous self.lock. seq avance
+        avant l'écriture : un lecteur hors verrou voit toujours l'élément en cours d'écrasement.
+        """
+        i = self.head
+        self.seq += 1
+        self.head = self.seq % self.max_size
+        if self.count < self.max_size:
+            self.count += 1
+        return i
+
+    def _clear(self):
+        self.head = 0
+        self.count = 0
+        self.seq = 0
+
+    def _index(self, k):
+        """Index dans les buffers du k-ième élément le plus récent (0 = le plus récent)."""
+        return (self.head - 1 - k) % self.max_size
+
+    def _logical(self, j):
+        """Index dans les buffers du j-ième élément le plus ancien (0 = le plus ancien)."""
+        return (self.head - self.count + j) % self.max_size
+
+    def _bisect(self, timestamp):
+        """
+        Nombre d'éléments avec un timestamp <= timestamp, par recherche dichotomique
+        (les éléments du buffer circulaire sont ordonnés dans le temps).
+        """
+        timestamps = self.timestamps
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if timestamps[self._logical(mid)] <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _bounds(self, from_ms=None, to_ms=None):
+        """Index logiques [start, end) des éléments avec from_ms < timestamp <= to_ms."""
+        start = self._bisect(from_ms) if from_ms is not None else 0
+        end = self._bisect(to_ms) if to_ms is not None else self.count
+        return start, end
+
+    def _seq_bounds(self, from_ms=None, to_ms=None, after_seq=None):
+        """
+        Séquences [start, end) des éléments avec from_ms < timestamp <= to_ms
+        (et seq > after_seq). Seule étape sous self.lock d'une lecture : O(log n).
+        """
+        with self.lock:
+            start, end = self._bounds(from_ms, to_ms)
+            first = self.seq - self.count
+        start += first
+        end += first
+        if after_seq is not None and after_seq + 1 > start:
+            start = min(after_seq + 1, end)
+        return start, end
+
+    def _iter(self, start, end, copy):
+        """
+        Générateur des copies hors verrou des éléments de séquence start <= seq < end, du plus
+        récent au plus ancien : copy(i) lit l'index i, puis la copie est écartée si l'écriture
+        en cours (self.seq) a pu l'écraser. Les éléments plus anciens le sont aussi.
+        """
+        max_size = self.max_size
+        for seq in range(end - 1, start - 1, -1):
+            item = copy(seq % max_size)
+            if self.seq > seq + max_size:
+                return
+            yield item
+
+    def _read(self, start, end, copy):
+        """Liste des copies de _iter."""
+        return list(self._iter(start, end, copy))
+
+
+class Tier(TimeRing):
+    """
+    Niveau d'historique agrégé : buckets de period_ms avec min / moyenne / max
+    de chaque champ et nombre de mesures. Alimenté incrémentalement par le
+    niveau inférieur (add), il alimente à son tour le niveau supérieur (parent)
+    à chaque bucket terminé.
+    """
+
+    def __init__(self, name, period_ms, max_size, fields, lock, parent=None):
+        TimeRing.__init__(self, max_size)
+        self.name = name
+        self.period_ms = period_ms
+        self.fields = fields
+        self.lock = lock
+        self.parent = parent
+        nb_fields = len(fields)
+        self.mins = [_alloc_array('f', max_size) for _ in range(nb_fields)]
+        self.avgs = [_alloc_array('f', max_size) for _ in range(nb_fields)]
+        self.maxs = [_alloc_array('f', max_size) for _ in range(nb_fields)]
+        self.counts = _alloc_array('I', max_size)
+        # Bucket en cours
+        self.bucket_ms = None
+        self.bucket_count = 0
+        self.bucket_min = [0.0] * nb_fields
+        self.bucket_sum = [0.0] * nb_fields
+        self.bucket_max = [0.0] * nb_fields
+
+    def add(self, timestamp, mins, avgs, maxs, count):
+        """Ajoute une mesure (mins = avgs = maxs, count = 1) ou un bucket du niveau inférieur."""
+        bucket_ms = timestamp - timestamp % self.period_ms
+        if bucket_ms != self.bucket_ms:
+            if self.bucket_count > 0:
+                self._close()
+            self.bucket_ms = bucket_ms
+            self.bucket_count = 0
+
+        bucket_min = self.bucket_min
+        bucket_sum = self.bucket_sum
+        bucket_max = self.bucket_max
+        first = self.bucket_count == 0
+        for k in range(len(bucket_sum)):
+            if first:
+                bucket_min[k] = mins[k]
+                bucket_max[k] = maxs[k]
+                bucket_sum[k] = avgs[k] * count
+            else:
+                if mins[k] < bucket_min[k]:
+                    bucket_min[k] = mins[k]
+                if maxs[k] > bucket_max[k]:
+                    bucket_max[k] = maxs[k]
+                bucket_sum[k] += avgs[k] * count
+        self.bucket_count += count
+
+    def _close(self):
+        """Range le bucket terminé dans le buffer et le transmet au niveau supérieur."""
+        count = self.bucket_count
+        avgs = self.bucket_sum
+        for k in range(len(avgs)):
+            avgs[k] = avgs[k] / count
+        with self.lock:
+            i = self._claim()
+            self.timestamps[i] = self.bucket_ms
+            self.counts[i] = count
+            for k in range(len(avgs)):
+                self.mins[k][i] = self.bucket_min[k]
+                self.avgs[k][i] = avgs[k]
+                self.maxs[k][i] = self.bucket_max[k]
+        if self.parent is not None:
+            self.parent.add(self.bucket_ms, self.bucket_min, avgs, self.bucket_max, count)
+
+    def json(self, i):
+        result = {"date": epoch_ms_to_iso_str(self.timestamps[i]), "count": self.counts[i]}
+        for k, field in enumerate(self.fields):
+            result[field] = self.avgs[k][i]
+            result[f"{field}_min"] = self.mins[k][i]
+            result[f"{field}_max"] = self.maxs[k][i]
+        return result
+
+    def between(self, from_ms=None, to_ms=None):
+        """Buckets avec from_ms < début <= to_ms, du plus récent au plus ancien."""
+        start, end = self._seq_bounds(from_ms, to_ms)
+        return self._read(start, end, self.json)
+
+
+class MinuteAccumulator:
+    """
+    Agrégat de la minute en cours, mis à jour à chaque mesure : sommes des
+    valeurs et énergies (intégrale des trapèzes de v * a, en Ws) par canal.
+    add() retourne la ligne de la minute terminée au changement de minute,
+    en O(1), sans copie ni relecture de l'historique.
+    """
+
+    def __init__(self, n_channels):
+        self.n_channels = n_channels
+        self.sums = [0.0] * (2 * n_channels + 1)  # v1, a1, ..., vN, aN, a
+        self.ws = [0.0] * n_channels
+        self.prev_power = [0.0] * n_channels
+        self.minute_ms = None  # Début de la minute en cours (ms depuis 1970)
+        self.length = 0
+        self.prev_ms = 0
+
+    def _reset(self, minute_ms):
+        self.minute_ms = minute_ms
+        self.length = 0
+        sums = self.sums
+        for i in range(len(sums)):
+            sums[i] = 0.0
+        ws = self.ws
+        for i in range(len(ws)):
+            ws[i] = 0.0
+
+    def row(self):
+        """(minute_ms, length, [avg_v1, avg_a1, ..., avg_a], [ws1, ..., wsN]) de la minute en cours."""
+        length = self.length
+        return (self.minute_ms, length, [value / length for value in self.sums], list(self.ws))
+
+    def add(self, timestamp, values, a):
+        """Ajoute une mesure, retourne la ligne de la minute précédente si elle vient de se terminer."""
+        finished = None
+        minute_ms = timestamp - timestamp % 60000
+        if minute_ms != self.minute_ms:
+            if self.length > 0:
+                finished = self.row()
+            self._reset(minute_ms)
+
+        sums = self.sums
+        n = self.n_channels
+        for i in range(2 * n):
+            sums[i] += values[i]
+        sums[2 * n] += a
+
+        # Trapèzes entre deux mesures consécutives de la même minute
+        prev_power = self.prev_power
+        ws = self.ws
+        delta_sec = (timestamp - self.prev_ms) / 1000
+        for channel in range(n):
+            power = values[2 * channel] * values[2 * channel + 1]
+            if self.length > 0:
+                ws[channel] += (power + prev_power[channel]) * delta_sec / 2
+            prev_power[channel] = power
+
+        self.prev_ms = timestamp
+        self.length += 1
+        return finished
+
+
+# Niveaux d'historique agrégé : nom (paramètre ?resolution=), durée d'un bucket en ms
+TIERS = (('10s', 10000), ('1m', 60000), ('1h', 3600000))
+TIER_DEFAULT_SIZES = {'10s': 360, '1m': 360, '1h': 168}
+DATAHIST_MIN_SIZE = 100
+
+def bytes_per_sample(n_channels):
+    """Octets de RAM par mesure brute : timestamp 'q' + un float par champ (v/a par canal, a, rate)."""
+    return 8 + 4 * (2 * n_channels + 2)
+
+def bytes_per_bucket(n_channels):
+    """Octets de RAM par bucket agrégé : timestamp 'q', compteur 'I', min / moyenne / max par champ."""
+    return 8 + 4 + 3 * 4 * (2 * n_channels + 1)
+
+def size_from_budget(percent, n_channels, tier_sizes=None):
+    """
+    Capacité du buffer des mesures brutes pour utiliser percent % de la RAM libre
+    (tas du GC, qui inclut la PSRAM quand le firmware l'y ajoute), déduction faite
+    des niveaux agrégés. Retourne (capacité, budget en octets).
+    """
+    if not 0 < percent <= 90:
+        raise ValueError(f"Invalid memory budget: {percent} - expected 0 < percent <= 90")
+    sizes = dict(TIER_DEFAULT_SIZES)
+    if tier_sizes:
+        sizes.update(tier_sizes)
+    gc.collect()
+    budget = int(gc.mem_free() * percent / 100)
+    available = budget - sum(sizes.values()) * bytes_per_bucket(n_channels)
+    return max(DATAHIST_MIN_SIZE, available // bytes_per_sample(n_channels)), budget
+
+
+class DataHist(TimeRing):
+    """
+    Historique des mesures en RAM, sur des buffers circulaires en colonnes
+    (un array par champ, préalloués) : ajout en O(1), sans allocation par
+    mesure. all() / all_after() retournent les mesures de la plus récente
+    à la plus ancienne.
+    Les mesures alimentent aussi des niveaux agrégés (TIERS : 10 s, 1 min,
+    1 h) de min / moyenne / max, chacun dans son propre buffer circulaire.
+    Elles sont sauvegardées par blocs toutes les journal_flush_s secondes dans
+    un journal binaire (voir Journal), relu au démarrage.
+    """
+    def __init__(self, max_size=1000, load_backup=True, n_channels=3, tier_sizes=None,
+                 dir_path='./data', journal_flush_s=5, journal_records=None,
+                 aggregate_batch_rows=10, aggregate_fsync=FSYNC_BATCH, retention=None):
+        """
+        Initialiser l'historique des données (n_channels : nombre de canaux v/a par mesure).
+        journal_records : mesures gardées par le journal à la compaction (JOURNAL_DEFAULT_RECORDS par
+        défaut, au plus max_size), limitées par l'espace flash libre (voir Journal.records_for_flash).
+        aggregate_batch_rows / aggregate_fsync : écriture des agrégats par minute (voir AggregateWriter).
+        retention : gestionnaire de l'espace flash (voir Retention), appelé par le thread d'écriture.
+        """
+        TimeRing.__init__(self, max_size)
+        self.n_channels = n_channels
+        # Noms des valeurs d'une mesure : v1, a1, ..., vN, aN, le courant global a puis la fréquence effective
+        self.fields = []
+        for channel in range(1, n_channels + 1):
+            self.fields.append(f"v{channel}")
+            self.fields.append(f"a{channel}")
+        self.fields.append("a")
+        self.fields.append("rate")
+        # Buffers circulaires : date en ms depuis 1970 (epoch, TimeRing), valeurs en float
+        self.columns = [_alloc_array('f', max_size) for _ in self.fields]
         self.rtc = RTC()
-        self.old_datetime = None
-        self.dir_path = './data'
-        self.backup_file_path = f"{self.dir_path}/backup_every_10_minutes.txt"
-        self.lock = _thread.allocate_lock()  # Verrou pour protéger l'accès à self.data
-        
+        self.minute = MinuteAccumulator(n_channels)
+        self.dir_path = dir_path
         try:
             os.listdir(self.dir_path)
         except OSError:
             os.mkdir(self.dir_path)
+        # Ancien backup texte (relu une fois si le journal est vide)
+        self.backup_file_path = f"{self.dir_path}/backup_every_10_minutes.txt"
+        self.lock = _thread.allocate_lock()  # Verrou pour protéger l'accès aux buffers
+
+        # Niveaux agrégés (sans la fréquence effective), du plus grossier au plus fin
+        sizes = dict(TIER_DEFAULT_SIZES)
+        if tier_sizes:
+            sizes.update(tier_sizes)
+        self.tiers = {}
+        parent = None
+        for name, period_ms in reversed(TIERS):
+            parent = Tier(name, period_ms, sizes[name], self.fields[:-1], self.lock, parent)
+            self.tiers[name] = parent
+        self._tier_input = [0.0] * (len(self.fields) - 1)
+
+        # Journal : mesures en attente dans un buffer préalloué, transmises par blocs au thread d'écriture
+        # Taille bornée, indépendante de la RAM : une compaction réécrit tout le snapshot
+        self.journal = Journal(self.dir_path, len(self.fields))
+        self.journal_records = self.journal.records_for_flash(min(journal_records or JOURNAL_DEFAULT_RECORDS, max_size))
+        self.journal.max_records = 2 * self.journal_records
+        self.journal_flush_ms = int(journal_flush_s * 1000)
+        self._journal_buf = bytearray(BLOCK_MAX_RECORDS * self.journal.record_size)
+        self._journal_pending = 0
+        self._journal_since = None  # Timestamp de la première mesure en attente
+        self._journal_seq = 0       # Séquence de fin du dernier bloc écrit (thread d'écriture)
+        self._legacy_backup = False
+        # Fichiers d'agrégats journaliers (thread d'écriture)
+        self.aggregates = AggregateWriter(self.dir_path, n_channels, aggregate_batch_rows, aggregate_fsync)
+        self.retention = retention
+        self.dropped_rows = 0  # Agrégats d'une minute perdus (file d'écriture pleine)
+
         if load_backup:
             self.load_backup()
 
-    def add(self, v1, a1, v2, a2, v3, a3):
+    def stats(self):
+        """Capacité et occupation mémoire des buffers (mesures brutes et niveaux agrégés)."""
+        sample_size = bytes_per_sample(self.n_channels)
+        bucket_size = bytes_per_bucket(self.n_channels)
+        tiers = {}
+        total = self.max_size * sample_size
+        for name, _ in TIERS:
+            tier = self.tiers[name]
+            tiers[name] = {'capacity': tier.max_size, 'count': tier.count}
+            total += tier.max_size * bucket_size
+        return {
+            'capacity': self.max_size,
+            'count': self.count,
+            'bytesPerSample': sample_size,
+            'bytesPerBucket': bucket_size,
+            'bytes': total,
+            'tiers': tiers,
+            'journal': self.journal.stats(),
+            'aggregates': self.aggregates.stats(),
+            'droppedRows': self.dropped_rows,
+        }
+
+    def add(self, values, a=None, rate=0):
+        """
+        Ajoute une mesure. values : [v1, a1, ..., vN, aN] (n_channels canaux).
+        a : courant global (registre somme shunt), moyenne des 3 premiers canaux si None.
+        rate : fréquence effective d'enregistrement en Hz (0 si inconnue).
+        """
+        if len(values) != 2 * self.n_channels:
+            raise ValueError(f"Expected {2 * self.n_channels} values, got {len(values)}")
+        if a is None:
+            a = (values[1] + values[3] + values[5]) / 3
         year, month, day, _, hour, minute, second, microseconds = self.rtc.datetime()
+        timestamp = datetime_to_epoch_ms(year, month, day, hour, minute, second, microseconds)
         # Ajouter les données avec verrouillage
         with self.lock:
-            self.data.insert(0, [year, month, day, hour, minute, second, microseconds, v1, a1, v2, a2, v3, a3])
-            if len(self.data) > self.max_size:
-                self.data.pop()  # Supprime la plus ancienne entrée
+            i = self._claim()
+            self.timestamps[i] = timestamp
+            self._push_values(i, values, a, rate)
+        self._feed_tiers(timestamp, values, a)
+        self._journal_push(i, timestamp)
 
-        if self.old_datetime is not None and minute != self.old_datetime[4]:
-            # Copier les données nécessaires pour éviter les conflits
-            with self.lock:
-                data_copy = self.data[:]  # Copie de self.data pour le thread
-            # Lancer process_daily dans un thread
-            _thread.start_new_thread(self._thread_process_daily, (data_copy, self.old_datetime))
-            if minute % 10 == 0:
-                # Lancer process_backup dans un thread
-                _thread.start_new_thread(self._thread_process_backup, (data_copy,))
-
-        self.old_datetime = (year, month, day, hour, minute, second, microseconds)
-
-    def _thread_process_daily(self, data_copy, process_datetime):
-        """Version thread-safe de process_daily."""
-        if not data_copy or not process_datetime:
+        # Agrégat de la minute mis à jour en continu
+        row = self.minute.add(timestamp, values, a)
+        if row is not None:
+            # Écriture de l'agrégat par le thread d'écriture
+            io_worker.submit('daily', self._thread_process_daily, row, on_drop=self._daily_dropped)
+
+    def _journal_push(self, i, timestamp):
+        """Met en attente la mesure à l'index i pour le journal, transmis par blocs (flush_journal)."""
+        journal = self.journal
+        struct.pack_into(journal.record_format, self._journal_buf, self._journal_pending * journal.record_size, *self._entry(i))
+        self._journal_pending += 1
+        if self._journal_since is None:
+            self._journal_since = timestamp
+        if self._journal_pending >= BLOCK_MAX_RECORDS or timestamp - self._journal_since >= self.journal_flush_ms:
+            self.flush_journal()
+
+    def flush_journal(self):
+        """Transmet les mesures en attente au thread d'écriture (un bloc du journal)."""
+        if self._journal_pending == 0:
             return
+        payload = bytes(memoryview(self._journal_buf)[:self._journal_pending * self.journal.record_size])
+        self._journal_pending = 0
+        self._journal_since = None
+        io_worker.submit('journal', self._thread_journal_append, payload, self.seq)
 
-        process_year, process_month, process_day, process_hour, process_minute = process_datetime[:5]
-        
-        sum_v1 = sum_v2 = sum_v3 = sum_a1 = sum_a2 = sum_a3 = 0
-        ws1 = ws2 = ws3 = 0
-        length = 0
-        prev_entry = None
-        
-        for entry in data_copy:
-            year, month, day, hour, minute, second, microseconds, v1, a1, v2, a2, v3, a3 = entry
-            if year == process_year and month == process_month and day == process_day and hour == process_hour and minute == process_minute:
-                sum_v1 += v1
-                sum_v2 += v2
-                sum_v3 += v3
-                sum_a1 += a1
-                sum_a2 += a2
-                sum_a3 += a3
-                
-                length += 1
-                if prev_entry is not None:
-                    delta_sec = (prev_entry[5] + prev_entry[6] / 1000000) - (second + microseconds / 1000000)
-                    ws1 += (v1 * a1 + prev_entry[7] * prev_entry[8]) * (delta_sec) / 2
-                    ws2 += (v2 * a2 + prev_entry[9] * prev_entry[10]) * (delta_sec) / 2
-                    ws3 += (v3 * a3 + prev_entry[11] * prev_entry[12]) * (delta_sec) / 2
-                prev_entry = entry
-            elif length > 0:
-                break 
-
-        if length > 0:
-            avg_v1 = sum_v1 / length
-            avg_v2 = sum_v2 / length
-            avg_v3 = sum_v3 / length
-            avg_a1 = sum_a1 / length
-            avg_a2 = sum_a2 / length
-            avg_a3 = sum_a3 / length
-            
-            date_iso_str = datetime_to_iso_str(process_year, process_month, process_day, process_hour, process_minute, 0 )
-
-            header = "date;avg_v1;avg_a1;ws1;avg_v2;avg_a2;ws2;avg_v3;avg_a3;ws3\n"
-            line_to_save = f"{date_iso_str};{avg_v1:.3f};{avg_a1:.3f};{ws1:.4f};{avg_v2:.3f};{avg_a2:.3f};{ws2:.4f};{avg_v3:.3f};{avg_a3:.3f};{ws3:.4f}\n"
-            
-            file_name = f"{process_year:04d}-{process_month:02d}-{process_day:02d}_daily_1_minute_aggregate.txt"
-            file_path = f"{self.dir_path}/{file_name}"
-
-            file_exists = False
-            try:
-                with self.lock:  # Protéger l'accès au système de fichiers
-                    all_files = os.listdir(self.dir_path)
-                    file_exists = file_name in all_files
-            except:
-                file_exists = False
-            
-            try:
-                with self.lock:  # Protéger l'écriture dans le fichier
-                    with open(file_path, 'a') as f:
-                        if not file_exists:
-                            f.write(header)
-                        f.write(line_to_save)
-                log(f"✅ Sauvegardé {length} échantillons → {file_path}")
-            except Exception as e:
-                log(f"❌ Erreur sauvegarde dans thread daily: {e}")
+    def _thread_journal_append(self, payload, end_seq):
+        """
+        Ajoute un bloc au journal (mesures de séquence < end_seq). Si un bloc précédent a été
+        perdu (file d'écriture pleine) ou si le segment est plein, le journal est compacté
+        à la place : réécrit depuis le buffer en RAM, qui contient aussi ce bloc.
+        """
+        journal = self.journal
+        start_seq = end_seq - len(payload) // journal.record_size
+        if start_seq != self._journal_seq or journal.needs_compaction():
+            journal.compact(lambda f: self._write_snapshot(f, end_seq))
+            if self._legacy_backup:
+                # Mesures de l'ancien backup texte reprises dans le journal
+                self._legacy_backup = False
+                try:
+                    os.remove(self.backup_file_path)
+                except OSError:
+                    pass
+        else:
+            journal.append(payload)
+        self._journal_seq = end_seq
+
+    def _write_snapshot(self, f, end_seq):
+        """
+        Écrit le snapshot en colonnes des journal_records dernières mesures de séquence < end_seq,
+        depuis les arrays, sans verrou (compaction du journal). Les plus anciennes, écrasées par
+        add() pendant l'écriture, sont comptées comme invalides (voir TimeRing._read) ; le crc32
+        est celui des octets écrits (voir write_columns).
+        Retourne (nombre de mesures, mesures invalides en tête, crc32, end_seq).
+        """
+        max_size = self.max_size
+        with self.lock:
+            start = max(self.seq - self.count, end_seq - self.journal_records)
+        start = min(start, end_seq)
+        count = end_seq - start
+        first = start % max_size
+        if first + count <= max_size:
+            slices = ((first, first + count),)
+        else:
+            slices = ((first, max_size), (0, first + count - max_size))
+        crc = write_columns(f, [self.timestamps] + self.columns, [8] + [4] * len(self.columns), slices)
+        skip = min(count, max(0, self.seq - max_size - start))
+        return count, skip, crc, end_seq
+
+    def _load_snapshot(self, f, count, skip, crc, end_seq, now_ms):
+        """
+        Lit le snapshot du journal directement dans les arrays (quelques readinto, sans
+        allocation par mesure), à leur index seq % max_size : la séquence reprend à end_seq,
+        les clients qui suivent seq ne voient pas de retour en arrière après un redémarrage.
+        Les mesures datées après now_ms sont ignorées.
+        Retourne le nombre de mesures chargées, None si le crc32 est invalide.
+        """
+        first = (end_seq - min(count, self.max_size)) % self.max_size
+        n, read_crc = read_columns(f, [self.timestamps] + self.columns, [8] + [4] * len(self.columns), count, self.max_size, first=first)
+        if read_crc != crc:
+            self._clear()
+            return None
+        self.seq = end_seq
+        self.head = end_seq % self.max_size
+        self.count = n - min(n, max(0, skip - (count - n)))
+        # Mesures les plus récentes datées dans le futur (RTC remise à zéro)
+        drop = self.count - self._bisect(now_ms - 1)
+        self.seq -= drop
+        self.head = self.seq % self.max_size
+        self.count -= drop
+        return self.count
+
+    def _push_values(self, i, values, a, rate):
+        """Écrit les valeurs à l'index i réservé par _claim() (la date est déjà écrite). Appelé sous self.lock."""
+        columns = self.columns
+        nb_values = len(values)
+        for k in range(nb_values):
+            columns[k][i] = values[k]
+        columns[nb_values][i] = a
+        columns[nb_values + 1][i] = rate
+
+    def _feed_tiers(self, timestamp, values, a):
+        """Transmet une mesure au niveau agrégé le plus fin (les suivants sont alimentés en cascade)."""
+        tier_input = self._tier_input
+        nb_values = len(values)
+        for k in range(nb_values):
+            tier_input[k] = values[k]
+        tier_input[nb_values] = a
+        self.tiers[TIERS[0][0]].add(timestamp, tier_input, tier_input, tier_input, 1)
+
+    def _push_entry(self, entry):
+        """Ajoute une entrée (timestamp ms, valeurs..., a, rate) comme mesure la plus récente."""
+        i = self._claim()
+        self.timestamps[i] = entry[0]
+        self._push_values(i, entry[1:-2], entry[-2], entry[-1])
+
+    def _replay_tiers(self):
+        """Alimente les niveaux agrégés avec les mesures du buffer (après chargement du backup)."""
+        nb_values = self.n_channels * 2
+        columns = self.columns
+        values = [0.0] * nb_values
+        for j in range(self.count):
+            i = self._logical(j)
+            for k in range(nb_values):
+                values[k] = columns[k][i]
+            self._feed_tiers(self.timestamps[i], values, columns[nb_values][i])
 
+    def _entry(self, i):
+        """Entrée (timestamp ms, v1, a1, ..., a, rate) à l'index i."""
+        return (self.timestamps[i],) + tuple(column[i] for column in self.columns)
+
+    def snapshot(self):
+        """Copie des mesures, de la plus récente à la plus ancienne (hors verrou, voir TimeRing._read)."""
+        start, end = self._seq_bounds()
+        return self._read(start, end, self._entry)
+
+    def _daily_dropped(self, row):
+        """Agrégat d'une minute abandonné par le thread d'écriture (file pleine) : perte tracée."""
+        self.dropped_rows += 1
+        log_err(f"❌ Agrégat de {epoch_ms_to_iso_str(row[0])} perdu: file d'écriture pleine")
+
+    def _thread_process_daily(self, row):
+        """Écrit l'agrégat d'une minute (voir MinuteAccumulator.row) dans le fichier binaire du jour, par lots."""
+        try:
+            self.aggregates.write(row)
+        except Exception as e:
+            log(f"❌ Erreur sauvegarde dans thread daily: {e}")
+        if self.retention is not None:
+            self.retention.tick(row[0])
 
     def load_backup(self):
-        self.data = []
-        
+        """
+        Recharge les mesures du journal au démarrage (snapshot binaire lu directement dans
+        les arrays, puis blocs ajoutés depuis), ou à défaut celles de l'ancien backup
+        texte (reprises dans le journal à la première écriture). Les mesures datées après
+        l'heure courante (RTC remise à zéro) sont ignorées.
+        """
+        with self.lock:
+            self._clear()
+
         now_year, now_month, now_day, _, now_hour, now_minute, now_second, now_microseconds = self.rtc.datetime()
-        now_date = (now_year, now_month, now_day, now_hour, now_minute, now_second, now_microseconds)
+        now_ms = datetime_to_epoch_ms(now_year, now_month, now_day, now_hour, now_minute, now_second, now_microseconds)
+
+        def push(entry):
+            if now_ms > entry[0]:
+                self._push_entry(entry)
+
+        def load_snapshot(f, count, skip, crc, end_seq):
+            return self._load_snapshot(f, count, skip, crc, end_seq, now_ms)
+
+        with self.lock:
+            recovered = self.journal.recover(load_snapshot, push)
+        if recovered == 0:
+            self._load_text_backup(now_ms)
+            # Première écriture du journal : compaction (reprend les mesures chargées)
+            self._legacy_backup = self.count > 0
+            self._journal_seq = 0 if self._legacy_backup else self.seq
+        else:
+            self._journal_seq = self.seq
+        self._replay_tiers()
+
+    def _load_text_backup(self, now_ms):
+        """Ancien format : backup_every_10_minutes.txt, une ligne date;valeurs par mesure, de la plus récente à la plus ancienne."""
+        entries = []
+        nb_values = 1 + 2 * self.n_channels
         
         try:
             with open(self.backup_file_path, 'r') as f:
                 for line in f:
                     if line.strip():
                         fields = line.strip().split(';')
-                        if len(fields) == 7:
-                            datetime_str, v1, a1, v2, a2, v3, a3 = fields
-                            data_date = parse_iso_date_str(datetime_str)
+                        # date + valeurs (+ courant global et fréquence, absents des anciens backups)
+                        if nb_values <= len(fields) <= nb_values + 2:
+                            timestamp = datetime_to_epoch_ms(*parse_iso_date_str(fields[0]))
                 
-                            if is_date_after(now_date, data_date):
-                                year, month, day, hour, minute, second, microseconds = data_date
-                                v1, a1, v2, a2, v3, a3 = map(float, (v1, a1, v2, a2, v3, a3))
-                                with self.lock:
-                                    self.data.append((year, month, day, hour, minute, second, microseconds, v1, a1, v2, a2, v3, a3))
-            log(f"✅ {len(self.data)} data chargées depuis {self.backup_file_path}")
+                            if now_ms > timestamp:
+                                values = list(map(float, fields[1:]))
+                                if len(fields) == nb_values:
+                                    values.append((values[1] + values[3] + values[5]) / 3)
+                                if len(fields) < nb_values + 2:
+                                    values.append(0)
+                                entries.append((timestamp,) + tuple(values))
+                                if len(entries) >= self.max_size:
+                                    break
+            with self.lock:
+                for entry in reversed(entries):
+                    self._push_entry(entry)
+            log(f"✅ {self.count} data chargées depuis {self.backup_file_path}")
         except OSError as e:
-            log_err(f"Fichier backup_every_10_minutes.txt introuvable ou erreur d'accès : {e}")
+            log_warn(f"Pas de backup texte à reprendre ({self.backup_file_path}) : {e}")
         except Exception as e:
             log_err(f"Erreur lors du chargement du backup : {e}")
-            
 
-    def _thread_process_backup(self, data_copy):
-        """Version thread-safe de process_backup."""
-        with self.lock:  # Protéger l'écriture dans le fichier
-            try:
-                with open(self.backup_file_path, 'w') as f:
-                    for entry in data_copy:
-                        year, month, day, hour, minute, second, microseconds, v1, a1, v2, a2, v3, a3 = entry
-                        date_iso_str = datetime_to_iso_str(year, month, day, hour, minute, second, microseconds )
-                        f.write(f"{date_iso_str};{v1:.3f};{a1:.3f};{v2:.3f};{a2:.3f};{v3:.3f};{a3:.3f}\n")
-                        
-                log(f"✅ Sauvegarde backup effectuée dans thread")
-            except Exception as e:
-                log_err(f"❌ Erreur sauvegarde backup dans thread: {e}")
+    def between(self, from_ms=None, to_ms=None, resolution='raw', after_seq=None, limit=None):
+        """
+        Mesures avec from_ms < timestamp <= to_ms (bornes en ms depuis 1970, None = sans borne),
+        de la plus récente à la plus ancienne. Recherche des bornes en O(log n) sous le verrou,
+        copie et sérialisation hors verrou : add() n'attend jamais la sérialisation.
+        resolution : 'raw' (mesures) ou un niveau agrégé de TIERS ('10s', '1m', '1h').
+        after_seq : mesures brutes de numéro de séquence > after_seq uniquement (lecture incrémentale).
+        limit : au plus limit éléments, les plus récents (les plus anciens après after_seq,
+        pour continuer la lecture incrémentale depuis le plus grand seq reçu).
+        """
+        return list(self.iter_between(from_ms, to_ms, resolution, after_seq, limit))
 
+    def iter_between(self, from_ms=None, to_ms=None, resolution='raw', after_seq=None, limit=None):
+        """
+        Comme between(), en générateur : chaque élément est copié et sérialisé au fil de
+        l'envoi, sans liste de la plage en RAM. Les paramètres sont vérifiés à l'appel.
+        """
+        if resolution != 'raw':
+            if resolution not in self.tiers:
+                raise ValueError(f"Invalid resolution: {resolution} - expected raw or one of {[name for name, _ in TIERS]}")
+            ring = self.tiers[resolution]
+            copy = ring.json
+            after_seq = None
+        else:
+            ring = self
+            copy = self._json_at
+        if limit is not None and limit < 1:
+            raise ValueError(f"Invalid limit: {limit} - expected a positive number")
 
+        start, end = ring._seq_bounds(from_ms, to_ms, after_seq)
+        if limit is not None:
+            if after_seq is not None:
+                end = min(end, start + limit)
+            else:
+                start = max(start, end - limit)
+        return ring._iter(start, end, copy)
 
-    def all_after(self, from_date):
-        with self.lock:
-            data = []
-            for entry in self.data:
-                if is_date_after(entry[:7], from_date):
-                    data.append(self.json(entry))
-                else:
-                    break
-        return data
+    def _json_at(self, i):
+        result = self.json(self._entry(i))
+        result["seq"] = self.seq_at(i)
+        return result
+
+    def seq_at(self, i):
+        """Numéro de séquence de la mesure à l'index i (la plus récente écrite à cet index)."""
+        seq = self.seq - 1
+        return seq - (seq - i) % self.max_size
+
+    def all_after(self, from_ms):
+        """Mesures strictement après from_ms (ms depuis 1970), de la plus récente à la plus ancienne."""
+        return self.between(from_ms=from_ms)
     
     def all(self):
-        with self.lock:
-            data = []
-            for entry in self.data:
-                data.append(self.json(entry))
-        return data
+        return self.between()
                     
     def json(self, entry=None):
         if entry is None:
             raise ValueError("entry should not be None")
-        year, month, day, hour, minute, second, microseconds, v1, a1, v2, a2, v3, a3 = entry        
-        date_iso_str = datetime_to_iso_str(year, month, day, hour, minute, second, microseconds )
-        return {
-            "date":  date_iso_str,
-            "v1": v1,
-            "a1": a1,
-            "v2": v2,
-            "a2": a2,
-            "v3": v3,
-            "a3": a3
-        }
\ No newline at end of file
+        date_iso_str = epoch_ms_to_iso_str(entry[0])
+        result = {"date":  date_iso_str}
+        for field, value in zip(self.fields, entry[1:]):
+            result[field] = value
+        return result
\ No newline at end of file
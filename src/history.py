@@ -0,0 +1,208 @@
+import os
+
+from aggregates import AggregateFile, AggregateIndex, aggregate_columns, AGGREGATE_SUFFIX, AGGREGATE_PERIOD_S, INDEX_SUFFIX, DAY_MS
+from retention import read_lines, deflate, DOWNSAMPLE_SUFFIX, DOWNSAMPLE_MINUTES
+from tools import epoch_ms_to_datetime, epoch_ms_to_iso_str, json_array_chunks
+from logger import log_warn
+
+HISTORY_CHUNK_SIZE = 1024  # Taille des morceaux de JSON envoyés
+
+
+def parse_fields(fields_str, n_channels):
+    """Liste des colonnes demandées ('avg_v1,ws1'), toutes si vide. Raises ValueError pour une colonne inconnue."""
+    columns = aggregate_columns(n_channels)
+    if not fields_str:
+        return columns
+    fields = [field.strip() for field in fields_str.split(',') if field.strip()]
+    for field in fields:
+        if field not in columns:
+            raise ValueError(f"Unknown field: {field} - expected one of {columns}")
+    return fields
+
+
+def parse_bucket(bucket_str):
+    """Durée d'un intervalle en secondes, multiple de AGGREGATE_PERIOD_S. Raises ValueError sinon."""
+    bucket_s = int(bucket_str)
+    if bucket_s < AGGREGATE_PERIOD_S or bucket_s % AGGREGATE_PERIOD_S:
+        raise ValueError(f"Invalid bucket: {bucket_s} - expected a multiple of {AGGREGATE_PERIOD_S} seconds")
+    return bucket_s
+
+
+def _binary_rows(path, from_ms, to_ms, fields):
+    """Lignes d'un fichier binaire : accès direct aux blocs des heures demandées, heures vides sautées (index)."""
+    aggregate = AggregateFile.load(path)
+    n = aggregate.n_channels
+    # Index de chaque colonne dans avgs + ws
+    indexes = {'avg_a': 2 * n}
+    for channel in range(n):
+        indexes[f"avg_v{channel + 1}"] = 2 * channel
+        indexes[f"avg_a{channel + 1}"] = 2 * channel + 1
+        indexes[f"ws{channel + 1}"] = 2 * n + 1 + channel
+    columns = [indexes.get(field) for field in fields]
+    period_ms = aggregate.period_s * 1000
+    from_slot = max(0, -(-(from_ms - aggregate.day_ms) // period_ms))
+    to_slot = min(aggregate.slots, -(-(to_ms - aggregate.day_ms) // period_ms))
+    if from_slot >= to_slot:
+        return
+    index = AggregateIndex.load(path + INDEX_SUFFIX)
+    for minute_ms, length, avgs, ws in aggregate.rows(from_slot, to_slot, index):
+        values = avgs + ws
+        yield minute_ms, 1, [values[k] if k is not None else None for k in columns]
+
+
+def _text_rows(path, day_ms, from_ms, to_ms, fields, minutes):
+    """
+    Lignes d'un fichier CSV (texte ou .gz). Un fichier texte indexé est lu à partir
+    de la première heure demandée (un seek), les autres depuis le début.
+    """
+    columns = None
+    offset = 0
+    index = None if path.endswith('.gz') else AggregateIndex.load(path + INDEX_SUFFIX)
+    if index is not None:
+        found = index.find((from_ms - day_ms) // 3600000)
+        if found is None:
+            return
+        offset = found[1]
+        with open(path, 'rb') as f:
+            columns = _columns(f.readline().decode().strip().split(';'), fields)
+    for line in read_lines(path, offset):
+        line = line.strip()
+        if not line:
+            continue
+        values = line.split(';')
+        if columns is None:
+            columns = _columns(values, fields)
+            continue
+        try:
+            date = values[0]
+            minute_ms = day_ms + (int(date[11:13]) * 60 + int(date[14:16])) * 60000
+            if minute_ms < from_ms:
+                continue
+            if minute_ms >= to_ms:
+                break
+            row = [float(values[k]) if k is not None else None for k in columns]
+        except (ValueError, IndexError):
+            # Ligne incomplète (coupure pendant l'ajout dans un ancien fichier texte)
+            log_warn(f"Historique : ligne invalide ignorée dans {path} : {line[:40]}")
+            continue
+        yield minute_ms, minutes, row
+
+
+def _columns(header, fields):
+    """Index de chaque colonne de fields dans une ligne CSV (None si absente), d'après l'en-tête."""
+    names = header[1:]
+    return [names.index(field) + 1 if field in names else None for field in fields]
+
+
+def _first(names, candidates):
+    """Premier nom de candidates présent dans names (les .gz seulement avec le module deflate), None sinon."""
+    for name in candidates:
+        if name not in names:
+            continue
+        if name.endswith('.gz') and deflate is None:
+            log_warn(f"Historique : module deflate absent, {name} ignoré")
+            continue
+        return name
+    return None
+
+
+def _day_sources(dir_path, names, day_ms, from_ms, to_ms, fields):
+    """
+    Sources d'un jour, dans l'ordre chronologique : (nom, générateur de lignes).
+    Le jour du passage au format binaire, l'ancien fichier texte (matin) précède
+    les agrégats binaires (ou leur CSV compressé) ; les fichiers mis de côté au
+    changement du nombre de canaux ('YYYY-MM-DD_<n>ch_...') précèdent celui du jour.
+    Sans agrégat du jour, le CSV réduit.
+    """
+    year, month, day = epoch_ms_to_datetime(day_ms)[:3]
+    prefix = f"{year:04d}-{month:02d}-{day:02d}"
+    sources = []
+    name = _first(names, (f"{prefix}{AGGREGATE_SUFFIX}.txt", f"{prefix}{AGGREGATE_SUFFIX}.txt.gz"))
+    if name is not None:
+        sources.append((name, _text_rows(f"{dir_path}/{name}", day_ms, from_ms, to_ms, fields, 1)))
+    current = (f"{prefix}{AGGREGATE_SUFFIX}.bin", f"{prefix}{AGGREGATE_SUFFIX}.csv.gz")
+    for name in sorted(names):
+        if not name.startswith(prefix + '_') or name in current:
+            continue
+        if name.endswith(f'{AGGREGATE_SUFFIX}.bin'):
+            sources.append((name, _binary_rows(f"{dir_path}/{name}", from_ms, to_ms, fields)))
+        elif name.endswith(f'{AGGREGATE_SUFFIX}.csv.gz') and _first(names, (name,)) is not None:
+            sources.append((name, _text_rows(f"{dir_path}/{name}", day_ms, from_ms, to_ms, fields, 1)))
+    name = f"{prefix}{AGGREGATE_SUFFIX}.bin"
+    if name in names:
+        sources.append((name, _binary_rows(f"{dir_path}/{name}", from_ms, to_ms, fields)))
+        return sources
+    name = _first(names, (f"{prefix}{AGGREGATE_SUFFIX}.csv.gz",))
+    if name is not None:
+        sources.append((name, _text_rows(f"{dir_path}/{name}", day_ms, from_ms, to_ms, fields, 1)))
+    else:
+        name = _first(names, (f"{prefix}{DOWNSAMPLE_SUFFIX}.csv.gz",))
+        if name is not None:
+            sources.append((name, _text_rows(f"{dir_path}/{name}", day_ms, from_ms, to_ms, fields, DOWNSAMPLE_MINUTES)))
+    return sources
+
+
+def history_rows(dir_path, from_ms, to_ms, fields):
+    """
+    Générateur des agrégats (minute_ms, minutes, valeurs des colonnes fields) de
+    [from_ms, to_ms), jour par jour, un seul fichier ouvert à la fois. Une valeur
+    vaut None si la colonne n'existe pas dans le fichier du jour. Les lignes déjà
+    couvertes par la source précédente du jour sont écartées (ordre chronologique).
+    Une source en erreur est ignorée : la réponse, déjà commencée, reste un JSON valide.
+    """
+    names = set(os.listdir(dir_path))
+    for day in range(from_ms // DAY_MS, (to_ms - 1) // DAY_MS + 1):
+        last_ms = -1
+        for name, rows in _day_sources(dir_path, names, day * DAY_MS, from_ms, to_ms, fields):
+            try:
+                for row in rows:
+                    if row[0] > last_ms:
+                        last_ms = row[0]
+                        yield row
+            except Exception as e:
+                log_warn(f"Historique : {name} ignoré : {e}")
+
+
+def history_buckets(dir_path, from_ms, to_ms, fields, bucket_s=AGGREGATE_PERIOD_S):
+    """
+    Générateur des intervalles de bucket_s secondes {date, count, colonnes...} :
+    moyenne des colonnes avg_ (pondérée par le nombre de minutes), somme des colonnes ws.
+    count : minutes agrégées. Un seul intervalle en RAM.
+    """
+    bucket_ms = bucket_s * 1000
+    is_ws = [field.startswith('ws') for field in fields]
+    start = None
+    count = 0
+    sums = None
+    weights = None
+    for minute_ms, minutes, values in history_rows(dir_path, from_ms, to_ms, fields):
+        bucket = minute_ms - minute_ms % bucket_ms
+        if bucket != start:
+            if count > 0:
+                yield _bucket_json(start, count, fields, sums, weights, is_ws)
+            start = bucket
+            count = 0
+            sums = [0.0] * len(fields)
+            weights = [0] * len(fields)
+        for k, value in enumerate(values):
+            if value is not None:
+                sums[k] += value if is_ws[k] else value * minutes
+                weights[k] += minutes
+        count += minutes
+    if count > 0:
+        yield _bucket_json(start, count, fields, sums, weights, is_ws)
+
+
+def _bucket_json(start, count, fields, sums, weights, is_ws):
+    bucket = {'date': epoch_ms_to_iso_str(start), 'count': count}
+    for field, value, weight, ws in zip(fields, sums, weights, is_ws):
+        if weight == 0:
+            bucket[field] = None
+        else:
+            bucket[field] = round(value, 4) if ws else round(value / weight, 3)
+    return bucket
+
+
+def history_json(dir_path, from_ms, to_ms, fields, bucket_s=AGGREGATE_PERIOD_S):
+    """Générateur du tableau JSON des intervalles, par morceaux de HISTORY_CHUNK_SIZE caractères."""
+    return json_array_chunks(history_buckets(dir_path, from_ms, to_ms, fields, bucket_s), HISTORY_CHUNK_SIZE)
@@ -0,0 +1,154 @@
+import time
+from machine import I2C, Pin
+from logger import log, log_warn, log_err
+
+# Fréquences candidates, de la plus rapide à la plus lente (Hz). Au-delà de 400 kHz,
+# l'INA3221 demande le mode high-speed (master code HS), que machine.I2C n'envoie pas :
+# 1 MHz seulement sur demande (I2C_FREQS dans .env)
+I2C_FREQS = (400000, 100000)
+I2C_DEFAULT_FREQ = 100000
+
+# Codes errno MicroPython : ENODEV = pas d'ACK de l'esclave, ETIMEDOUT = bus bloqué
+ERRNO_ENODEV = 19
+ERRNO_ETIMEDOUT = 110
+
+
+class I2CBus:
+    """
+    Bus I2C partagé par les capteurs, avec gestion adaptative de la fréquence.
+    - negotiate() choisit la fréquence la plus rapide qui passe un test de lectures.
+    - Les capteurs signalent chaque transaction (transactions) et chaque
+      OSError (record_error). Si plus de max_errors erreurs surviennent en
+      moins de `window` transactions, le bus est débloqué puis recréé à la
+      fréquence inférieure.
+    """
+
+    def __init__(self, scl_pin=9, sda_pin=8, freqs=I2C_FREQS, freq=I2C_DEFAULT_FREQ, window=1000, max_errors=5):
+        self.scl_pin = scl_pin
+        self.sda_pin = sda_pin
+        self.freqs = sorted(freqs, reverse=True)
+        self.window = window
+        self.max_errors = max_errors
+
+        self.transactions = 0
+        self.errors = 0
+        self.nacks = 0
+        self.timeouts = 0
+        self.step_downs = 0
+        self._window_start = 0
+        self._window_errors = 0
+
+        self.freq = freq
+        self.i2c = I2C(0, scl=Pin(self.scl_pin), sda=Pin(self.sda_pin), freq=self.freq)
+
+    def _set_freq(self, freq):
+        self.freq = freq
+        self.i2c = I2C(0, scl=Pin(self.scl_pin), sda=Pin(self.sda_pin), freq=self.freq)
+
+    def negotiate(self, addrs, probe_reg=0xFE, tries=20):
+        """
+        Essaie chaque fréquence (de la plus rapide à la plus lente) : la
+        fréquence est retenue si `tries` lectures de probe_reg sur chaque
+        adresse réussissent et retournent la même valeur qu'à 100 kHz.
+        """
+        buf = bytearray(2)
+        expected = {}
+        for addr in addrs:
+            try:
+                self.i2c.readfrom_mem_into(addr, probe_reg, buf)
+                expected[addr] = bytes(buf)
+            except OSError as e:
+                log_warn(f"Négociation I2C - pas de réponse de {hex(addr)}: {e}")
+        if not expected:
+            return self.freq
+
+        for freq in self.freqs:
+            try:
+                self._set_freq(freq)
+                for _ in range(tries):
+                    for addr, value in expected.items():
+                        self.i2c.readfrom_mem_into(addr, probe_reg, buf)
+                        if buf != value:
+                            raise OSError(f"invalid value {buf}")
+                log(f"Bus I2C négocié à {freq} Hz")
+                return freq
+            except OSError as e:
+                log_warn(f"Bus I2C instable à {freq} Hz: {e}")
+                self.reset()
+
+        self._set_freq(self.freqs[-1])
+        return self.freq
+
+    def record_error(self, e):
+        """Compte une erreur de transaction et descend la fréquence si le taux d'erreur est trop élevé."""
+        self.errors += 1
+        errno = e.args[0] if e.args else None
+        if errno == ERRNO_ENODEV:
+            self.nacks += 1
+        elif errno == ERRNO_ETIMEDOUT:
+            self.timeouts += 1
+
+        if self.transactions - self._window_start >= self.window:
+            self._window_start = self.transactions
+            self._window_errors = 0
+        self._window_errors += 1
+
+        if self._window_errors >= self.max_errors:
+            self.step_down()
+
+    def step_down(self):
+        """Débloque le bus et le recrée à la fréquence inférieure (si elle existe)."""
+        lower = [freq for freq in self.freqs if freq < self.freq]
+        self._window_start = self.transactions
+        self._window_errors = 0
+        if not lower:
+            log_warn(f"Bus I2C: trop d'erreurs à {self.freq} Hz, fréquence minimale atteinte")
+            return self.reset()
+        self.step_downs += 1
+        log_warn(f"Bus I2C: trop d'erreurs, {self.freq} Hz → {lower[0]} Hz")
+        self.freq = lower[0]
+        return self.reset()
+
+    def reset(self):
+        """
+        Réinitialise le bus I2C en cas d'erreur.
+        - Débloque le bus en envoyant des impulsions sur SCL.
+        - Recrée l'objet I2C.
+        """
+        log("Réinitialisation du bus I2C...")
+        
+        # Étape 1 : Débloquer le bus I2C
+        scl = Pin(self.scl_pin, Pin.OUT)
+        sda = Pin(self.sda_pin, Pin.OUT)
+        
+        # Envoyer 9 impulsions sur SCL pour débloquer un esclave coincé
+        scl.value(1)
+        for _ in range(9):
+            scl.value(0)
+            time.sleep_us(100)  # Pause de 100 µs
+            scl.value(1)
+            time.sleep_us(100)
+        
+        # S'assurer que SDA et SCL sont à l'état haut
+        sda.value(1)
+        scl.value(1)
+        time.sleep_us(100)
+        
+        # Étape 2 : Recréer l'objet I2C
+        try:
+            self.i2c = I2C(0, scl=Pin(self.scl_pin), sda=Pin(self.sda_pin), freq=self.freq)
+            log(f"Bus I2C réinitialisé ({self.freq} Hz)")
+        except Exception as e:
+            log_err("Erreur lors de la réinitialisation I2C:", e)
+            return False
+        return True
+
+    def stats(self):
+        return {
+            'freq': self.freq,
+            'transactions': self.transactions,
+            'errors': self.errors,
+            'nacks': self.nacks,
+            'timeouts': self.timeouts,
+            'stepDowns': self.step_downs,
+        }
@@ -1,5 +1,6 @@
 import time
-from machine import I2C, Pin
+import _thread
+from i2cBus import I2CBus
 from logger import log, log_warn, log_err
 
 # Adresses du capteur INA3221
@@ -12,64 +13,98 @@ INA3221_ADDRS = {
 
 # Registres du INA3221
 INA3221_REG_CONF = 0x00
-INA3221_REG_SHUNTV_SUM = 0x11
+INA3221_REG_CH1_SHUNTV = 0x01  # Registres canaux contigus : shunt1, bus1, shunt2, bus2, shunt3, bus3
+INA3221_NB_CHANNEL_REGS = 6
+INA3221_REG_SHUNTV_SUM = 0x0D  # Somme des tensions shunt des canaux sélectionnés (bits SCC)
+INA3221_REG_MASK_ENABLE = 0x0F
 INA3221_REG_MANUF_ID = 0xFE
 INA3221_REG_DIE_ID = 0xFF
 INA3221_REG_RESET = 0x8000
 
+# Bits du registre de configuration / mask-enable
+INA3221_CONF_CH_EN_SHIFT = 12   # Bits 14..12 : CH1, CH2, CH3 enable
+INA3221_CONF_AVG_SHIFT = 9      # Bits 11..9 : moyennage
+INA3221_CONF_VBUS_CT_SHIFT = 6  # Bits 8..6 : temps de conversion bus
+INA3221_CONF_VSH_CT_SHIFT = 3   # Bits 5..3 : temps de conversion shunt
+INA3221_CONF_MODE_MASK = 0x0007
+INA3221_MODE_CONTINUOUS = 0x0007  # Shunt + bus en continu
+INA3221_MASK_CVRF = 0x0001  # Conversion ready flag (remis à 0 par la lecture du registre)
+INA3221_MASK_SCC_SHIFT = 12  # Bits 14..12 : SCC1, SCC2, SCC3 (canaux inclus dans la somme shunt)
+
+# Valeurs possibles, l'index est la valeur du champ dans le registre de configuration
+INA3221_AVG = (1, 4, 16, 64, 128, 256, 512, 1024)
+INA3221_CONV_TIME_US = (140, 204, 332, 588, 1100, 2116, 4156, 8244)
+INA3221_MODES = {
+    'power_down': 0,
+    'shunt_triggered': 1,
+    'bus_triggered': 2,
+    'triggered': 3,
+    'shunt_continuous': 5,
+    'bus_continuous': 6,
+    'continuous': 7,
+}
+
+# Durée d'un cycle complet de conversion avec la configuration par défaut (µs) :
+# 3 canaux x (shunt 1.1 ms + bus 1.1 ms), moyennage 1
+INA3221_DEFAULT_CONVERSION_PERIOD_US = 6600
+
 # Classe INA3221
 class INA3221:
-    def __init__(self, scl_pin=9, sda_pin=8,addr=INA3221_ADDRS[0]):
+    def __init__(self, scl_pin=9, sda_pin=8,addr=INA3221_ADDRS[0], bus=None):
         
         self.scl_pin = scl_pin
         self.sda_pin = sda_pin
-        self.i2c = I2C(0, scl=Pin(self.scl_pin), sda=Pin(self.sda_pin), freq=100000)
+        # bus : I2CBus partagé avec d'autres capteurs (voir acquisition.py)
+        self.bus = bus or I2CBus(scl_pin=self.scl_pin, sda_pin=self.sda_pin)
         self.addr = addr
         self.shunt_res = [100, 100, 100]  # Valeur par défaut des résistances de shunt en mOhm
+        self.sum_channels = []  # Canaux inclus dans le registre de somme shunt
+        self.conversion_period_us = INA3221_DEFAULT_CONVERSION_PERIOD_US
+        self.lock = _thread.allocate_lock()  # Le thread HTTP et le thread capteur partagent les buffers
+
+        # Buffers préalloués : aucune allocation dans les lectures/écritures de registres
+        self._reg_buf = bytearray(2)
+        self._burst_buf = bytearray(2 * INA3221_NB_CHANNEL_REGS)
+        burst_mv = memoryview(self._burst_buf)
+        self._burst_slices = [burst_mv[i * 2:i * 2 + 2] for i in range(INA3221_NB_CHANNEL_REGS)]
+
+    # Objet machine.I2C courant (recréé par le bus en cas de changement de fréquence)
+    @property
+    def i2c(self):
+        return self.bus.i2c
 
-    # Lire un registre de 16 bits
+    # Lire un registre de 16 bits (sans allocation)
     def _read_register(self, reg):
-        self.i2c.writeto(self.addr, bytes([reg]))
-        data = self.i2c.readfrom(self.addr, 2)
-        return int.from_bytes(data, "big")
+        buf = self._reg_buf
+        with self.lock:
+            try:
+                self.bus.i2c.readfrom_mem_into(self.addr, reg, buf)
+            except OSError as e:
+                self.bus.record_error(e)
+                raise
+            self.bus.transactions += 1
+            return (buf[0] << 8) | buf[1]
 
-    # Écrire dans un registre de 16 bits
+    # Lecture brute d'un registre (utilisée par la capture en rafale)
+    def read_register(self, reg):
+        return self._read_register(reg)
+
+    # Écrire dans un registre de 16 bits (sans allocation)
     def _write_register(self, reg, value):
-        self.i2c.writeto(self.addr, bytes([reg, (value >> 8) & 0xFF, value & 0xFF]))
+        buf = self._reg_buf
+        with self.lock:
+            buf[0] = (value >> 8) & 0xFF
+            buf[1] = value & 0xFF
+            try:
+                self.bus.i2c.writeto_mem(self.addr, reg, buf)
+            except OSError as e:
+                self.bus.record_error(e)
+                raise
+            self.bus.transactions += 1
 
     def reset_i2c(self):
-        """
-        Réinitialise le bus I2C en cas d'erreur.
-        - Débloque le bus en envoyant des impulsions sur SCL.
-        - Recrée l'objet I2C.
-        """
-        log("Réinitialisation du bus I2C...")
-        
-        # Étape 1 : Débloquer le bus I2C
-        scl = Pin(self.scl_pin, Pin.OUT)
-        sda = Pin(self.sda_pin, Pin.OUT)
-        
-        # Envoyer 9 impulsions sur SCL pour débloquer un esclave coincé
-        scl.value(1)
-        for _ in range(9):
-            scl.value(0)
-            time.sleep_us(100)  # Pause de 100 µs
-            scl.value(1)
-            time.sleep_us(100)
-        
-        # S'assurer que SDA et SCL sont à l'état haut
-        sda.value(1)
-        scl.value(1)
-        time.sleep_us(100)
-        
-        # Étape 2 : Recréer l'objet I2C
-        try:
-            self.i2c = I2C(0, scl=Pin(self.scl_pin), sda=Pin(self.sda_pin), freq=100000)
-            log("Bus I2C réinitialisé")
-        except Exception as e:
-            log_err("Erreur lors de la réinitialisation I2C:", e)
-            return False
-        return True
+        """Réinitialise le bus I2C en cas d'erreur (voir I2CBus.reset)."""
+        return self.bus.reset()
 
     # Lire l'ID du fabricant (doit être 0x5449)
     def get_manuf_id(self):
@@ -83,6 +118,144 @@ class INA3221:
     def reset(self):
         log("Reset du capteur INA3221")
         self._write_register(INA3221_REG_CONF, INA3221_REG_RESET)
+        self.conversion_period_us = INA3221_DEFAULT_CONVERSION_PERIOD_US
+
+    # Passer le capteur en mode continu (shunt + bus)
+    def set_continuous(self):
+        self.configure(mode='continuous')
+
+    def configure(self, avg=None, vbus_ct_us=None, vsh_ct_us=None, mode=None, channels=None):
+        """
+        Modifie la configuration du capteur, sans reset ni reboot.
+        - avg : nombre de moyennes (voir INA3221_AVG)
+        - vbus_ct_us / vsh_ct_us : temps de conversion bus / shunt en µs (voir INA3221_CONV_TIME_US)
+        - mode : clé de INA3221_MODES
+        - channels : canaux actifs, ex. (1, 2, 3)
+        Les paramètres à None gardent la valeur actuelle.
+        Lève ValueError si une valeur n'est pas supportée par l'INA3221.
+        """
+        conf = self._read_register(INA3221_REG_CONF)
+
+        if avg is not None:
+            if avg not in INA3221_AVG:
+                raise ValueError(f"Invalid avg: {avg} - expected one of {INA3221_AVG}")
+            conf = (conf & ~(0x7 << INA3221_CONF_AVG_SHIFT)) | (INA3221_AVG.index(avg) << INA3221_CONF_AVG_SHIFT)
+
+        if vbus_ct_us is not None:
+            if vbus_ct_us not in INA3221_CONV_TIME_US:
+                raise ValueError(f"Invalid vbus_ct_us: {vbus_ct_us} - expected one of {INA3221_CONV_TIME_US}")
+            conf = (conf & ~(0x7 << INA3221_CONF_VBUS_CT_SHIFT)) | (INA3221_CONV_TIME_US.index(vbus_ct_us) << INA3221_CONF_VBUS_CT_SHIFT)
+
+        if vsh_ct_us is not None:
+            if vsh_ct_us not in INA3221_CONV_TIME_US:
+                raise ValueError(f"Invalid vsh_ct_us: {vsh_ct_us} - expected one of {INA3221_CONV_TIME_US}")
+            conf = (conf & ~(0x7 << INA3221_CONF_VSH_CT_SHIFT)) | (INA3221_CONV_TIME_US.index(vsh_ct_us) << INA3221_CONF_VSH_CT_SHIFT)
+
+        if mode is not None:
+            if mode not in INA3221_MODES:
+                raise ValueError(f"Invalid mode: {mode} - expected one of {list(INA3221_MODES)}")
+            conf = (conf & ~INA3221_CONF_MODE_MASK) | INA3221_MODES[mode]
+
+        if channels is not None:
+            ch_en = 0
+            for channel in channels:
+                if channel not in (1, 2, 3):
+                    raise ValueError(f"Invalid channel: {channel} - expected 1, 2 or 3")
+                ch_en |= 1 << (3 - channel)  # CH1 = bit 14, CH3 = bit 12
+            conf = (conf & ~(0x7 << INA3221_CONF_CH_EN_SHIFT)) | (ch_en << INA3221_CONF_CH_EN_SHIFT)
+
+        conf &= ~INA3221_REG_RESET
+        self._write_register(INA3221_REG_CONF, conf)
+        config = self.get_config(conf)
+        self.conversion_period_us = config['conversion_period_us']
+        log(f"Configuration INA3221: {config}")
+        return config
+
+    def get_config(self, conf=None):
+        """Retourne la configuration du capteur en valeurs physiques."""
+        if conf is None:
+            conf = self._read_register(INA3221_REG_CONF)
+
+        avg = INA3221_AVG[(conf >> INA3221_CONF_AVG_SHIFT) & 0x7]
+        vbus_ct_us = INA3221_CONV_TIME_US[(conf >> INA3221_CONF_VBUS_CT_SHIFT) & 0x7]
+        vsh_ct_us = INA3221_CONV_TIME_US[(conf >> INA3221_CONF_VSH_CT_SHIFT) & 0x7]
+        mode_value = conf & INA3221_CONF_MODE_MASK
+        mode = 'power_down'
+        for name, value in INA3221_MODES.items():
+            if value == mode_value:
+                mode = name
+        channels = [channel for channel in (1, 2, 3) if conf & (1 << (INA3221_CONF_CH_EN_SHIFT + 3 - channel))]
+
+        # Durée d'un cycle complet : chaque canal actif convertit shunt et/ou bus, avg fois
+        cycle_us = 0
+        if mode_value & 0x1:
+            cycle_us += vsh_ct_us
+        if mode_value & 0x2:
+            cycle_us += vbus_ct_us
+        conversion_period_us = avg * len(channels) * cycle_us
+
+        return {
+            'avg': avg,
+            'vbus_ct_us': vbus_ct_us,
+            'vsh_ct_us': vsh_ct_us,
+            'mode': mode,
+            'channels': channels,
+            'conversion_period_us': conversion_period_us or INA3221_DEFAULT_CONVERSION_PERIOD_US,
+        }
+
+    # Vrai si un nouveau cycle de conversion est terminé depuis la dernière lecture du flag
+    def is_conversion_ready(self):
+        return bool(self._read_register(INA3221_REG_MASK_ENABLE) & INA3221_MASK_CVRF)
+
+    def wait_conversion_ready(self, since_us=None, timeout_us=None, poll_us=200):
+        """
+        Attend la fin du cycle de conversion en cours (flag CVRF).
+        - since_us : ticks_us du dernier flag reçu. Le thread dort jusqu'à la
+          fin théorique du cycle avant de sonder le registre, pour ne pas
+          gaspiller de lectures I2C.
+        - Retourne False si le flag n'est pas levé avant timeout_us.
+        """
+        if timeout_us is None:
+            timeout_us = 2 * self.conversion_period_us
+        if since_us is not None:
+            remaining = self.conversion_period_us - time.ticks_diff(time.ticks_us(), since_us) - poll_us
+            if remaining > 0:
+                time.sleep_us(remaining)
+
+        start = time.ticks_us()
+        while not self.is_conversion_ready():
+            if time.ticks_diff(time.ticks_us(), start) >= timeout_us:
+                return False
+            time.sleep_us(poll_us)
+        return True
+
+    def set_summation(self, channels=(1, 2, 3)):
+        """
+        Sélectionne les canaux additionnés par le registre de somme shunt (bits SCC).
+        La somme n'a de sens que si les résistances de shunt des canaux sont identiques.
+        """
+        scc = 0
+        for channel in channels:
+            if channel not in (1, 2, 3):
+                raise ValueError(f"Invalid channel: {channel} - expected 1, 2 or 3")
+            scc |= 1 << (3 - channel)  # SCC1 = bit 14, SCC3 = bit 12
+        mask = self._read_register(INA3221_REG_MASK_ENABLE)
+        mask = (mask & ~(0x7 << INA3221_MASK_SCC_SHIFT)) | (scc << INA3221_MASK_SCC_SHIFT)
+        self._write_register(INA3221_REG_MASK_ENABLE, mask)
+        self.sum_channels = list(channels)
+        log(f"Somme shunt INA3221 - canaux: {self.sum_channels}")
+
+    # Lire la somme des tensions de shunt, dans la même unité que get_shunt_voltage
+    def get_shunt_voltage_sum(self):
+        # Registre somme : données sur les bits 15..1, registre canal : bits 15..3 (même LSB 40 µV)
+        return (self._read_register(INA3221_REG_SHUNTV_SUM) & 0xFFFE) * 4
+
+    # Courant global (moyenne des canaux sommés) en une seule lecture de registre
+    def get_global_current(self):
+        if not self.sum_channels:
+            raise ValueError("Shunt summation not enabled, call set_summation() first")
+        raw = self.get_shunt_voltage_sum() / len(self.sum_channels)
+        return self.current_from_raw(self.sum_channels[0] - 1, raw)
 
     # Lire la tension de shunt pour un canal spécifique (en µV)
     def get_shunt_voltage(self, channel):
@@ -92,9 +265,44 @@ class INA3221:
     # Lire la tension de bus pour un canal spécifique (en V)
     def get_bus_voltage(self, channel):
         reg = 0x02 + (channel * 2)
-        return self._read_register(reg) * 0.001  # Conversion en Volts
+        return self.bus_voltage_from_raw(self._read_register(reg))  # Conversion en Volts
 
     # Lire le courant pour un canal spécifique (en mA)
     def get_current(self, channel):
         voltage = self.get_shunt_voltage(channel)
-        return voltage / self.shunt_res[channel] * 0.001 # Utiliser la loi d'Ohm (I = V/R)
+        return self.current_from_raw(channel, voltage)
+
+    def read_all_channels(self, out):
+        """
+        Lit les 6 registres canaux (shunt1, bus1, shunt2, bus2, shunt3, bus3)
+        et écrit les valeurs brutes dans `out` (list ou array de taille >= 6).
+        - L'INA3221 n'auto-incrémente pas son pointeur de registre : une
+          transaction combinée (pointeur + repeated start + lecture) par
+          registre est le minimum, soit 6 transactions au lieu de 12.
+        - Aucun buffer n'est alloué : les slices memoryview sont préparées
+          dans __init__.
+        """
+        bus = self.bus
+        i2c = bus.i2c
+        addr = self.addr
+        buf = self._burst_buf
+        slices = self._burst_slices
+        with self.lock:
+            try:
+                for i in range(INA3221_NB_CHANNEL_REGS):
+                    i2c.readfrom_mem_into(addr, INA3221_REG_CH1_SHUNTV + i, slices[i])
+            except OSError as e:
+                bus.record_error(e)
+                raise
+            bus.transactions += INA3221_NB_CHANNEL_REGS
+            for i in range(INA3221_NB_CHANNEL_REGS):
+                out[i] = (buf[i * 2] << 8) | buf[i * 2 + 1]
+        return out
+
+    # Conversion d'une valeur brute de registre bus en Volts
+    def bus_voltage_from_raw(self, raw):
+        return raw * 0.001
+
+    # Conversion d'une valeur brute de registre shunt en courant
+    def current_from_raw(self, channel, raw):
+        return raw / self.shunt_res[channel] * 0.001 # Utiliser la loi d'Ohm (I = V/R)
@@ -0,0 +1,147 @@
+import time
+import _thread
+
+from logger import log_warn, log_err
+
+# Politiques quand la file est pleine
+OVERFLOW_DROP_OLDEST = 'drop_oldest'  # Le job le plus ancien de la file est abandonné
+OVERFLOW_DROP_NEWEST = 'drop_newest'  # Le nouveau job est refusé (submit retourne False)
+
+
+class IOWorker:
+    """
+    Thread unique et permanent pour les écritures flash (agrégats, backups, captures).
+    - Les jobs sont mis en file par submit() depuis n'importe quel thread ;
+      le thread d'acquisition n'attend jamais la flash.
+    - File bornée à max_jobs : quand elle est pleine, la politique
+      'drop_oldest' abandonne le job le plus ancien, 'drop_newest' refuse
+      le nouveau. Les jobs abandonnés sont comptés dans `dropped`, et leur
+      callback on_drop (voir submit) est appelé : l'appelant peut remettre
+      son état à zéro ou tracer la perte.
+    - Un job qui lève une exception est compté dans `failed`, le thread continue.
+    """
+    _instance = None  # ← Worker singleton !
+
+    def __new__(cls, *args, **kwargs):
+        """IOWorker : Une seule instance TOUJOURS"""
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, max_jobs=8, overflow=OVERFLOW_DROP_OLDEST):
+        if not hasattr(self, 'initialized'):
+            self.initialized = True
+            self.max_jobs = max_jobs
+            self.overflow = overflow
+            self.jobs = []  # (ticks_ms de mise en file, nom, fonction, arguments, on_drop)
+            self.lock = _thread.allocate_lock()
+            # Verrou utilisé comme sémaphore : le thread dort dessus quand la file est vide
+            self.wakeup = _thread.allocate_lock()
+            self.wakeup.acquire()
+            self.started = False
+
+            self.submitted = 0
+            self.done = 0
+            self.failed = 0
+            self.dropped = 0
+            self.max_depth = 0
+            self.last_latency_ms = 0   # Attente en file + exécution du dernier job
+            self.max_latency_ms = 0
+            self.total_latency_ms = 0
+
+    def configure(self, max_jobs=None, overflow=None):
+        if max_jobs is not None:
+            self.max_jobs = max_jobs
+        if overflow is not None:
+            if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+                raise ValueError(f"Invalid overflow policy: {overflow}")
+            self.overflow = overflow
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        _thread.start_new_thread(self._run, ())
+
+    def submit(self, name, fn, *args, on_drop=None):
+        """
+        Met un job en file. Retourne False si le job a été refusé (file pleine, 'drop_newest').
+        on_drop(*args) est appelé si le job est refusé ou abandonné sans avoir été exécuté.
+        """
+        if not self.started:
+            self.start()
+        refused = False
+        dropped = None
+        with self.lock:
+            if len(self.jobs) >= self.max_jobs:
+                self.dropped += 1
+                if self.overflow == OVERFLOW_DROP_NEWEST:
+                    log_warn(f"IOWorker: file pleine, job {name} refusé")
+                    refused = True
+                else:
+                    dropped = self.jobs.pop(0)
+                    log_warn(f"IOWorker: file pleine, job {dropped[1]} abandonné")
+            if not refused:
+                self.jobs.append((time.ticks_ms(), name, fn, args, on_drop))
+                self.submitted += 1
+                if len(self.jobs) > self.max_depth:
+                    self.max_depth = len(self.jobs)
+                if self.wakeup.locked():
+                    self.wakeup.release()
+        # Callbacks hors verrou : ils peuvent soumettre à nouveau
+        if refused:
+            self._dropped(name, args, on_drop)
+            return False
+        if dropped is not None:
+            self._dropped(dropped[1], dropped[3], dropped[4])
+        return True
+
+    def _dropped(self, name, args, on_drop):
+        """Appelle le callback on_drop d'un job refusé ou abandonné."""
+        if on_drop is None:
+            return
+        try:
+            on_drop(*args)
+        except Exception as e:
+            log_err(f"IOWorker: erreur on_drop du job {name}: {e}")
+
+    def _run(self):
+        while True:
+            self.wakeup.acquire()
+            while True:
+                with self.lock:
+                    if not self.jobs:
+                        break
+                    queued_ms, name, fn, args, _ = self.jobs.pop(0)
+                try:
+                    fn(*args)
+                    self.done += 1
+                except Exception as e:
+                    self.failed += 1
+                    log_err(f"IOWorker: erreur job {name}: {e}")
+                latency = time.ticks_diff(time.ticks_ms(), queued_ms)
+                self.last_latency_ms = latency
+                self.total_latency_ms += latency
+                if latency > self.max_latency_ms:
+                    self.max_latency_ms = latency
+
+    def stats(self):
+        finished = self.done + self.failed
+        return {
+            'depth': len(self.jobs),
+            'maxDepth': self.max_depth,
+            'maxJobs': self.max_jobs,
+            'overflow': self.overflow,
+            'submitted': self.submitted,
+            'done': self.done,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'latency.last_ms': self.last_latency_ms,
+            'latency.max_ms': self.max_latency_ms,
+            'latency.avg_ms': self.total_latency_ms // finished if finished else 0,
+        }
+
+
+# === Instance unique ===
+io_worker = IOWorker()
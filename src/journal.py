@@ -0,0 +1,298 @@
+import os
+import struct
+import binascii
+
+from logger import log, log_warn, log_err
+
+# En-tête de segment : magic, version, nombre de valeurs par mesure, taille d'un enregistrement, génération
+JOURNAL_MAGIC = b'DHJ1'
+JOURNAL_VERSION = 3
+JOURNAL_HEADER = '<4sBBHI'
+JOURNAL_HEADER_SIZE = struct.calcsize(JOURNAL_HEADER)
+# Snapshot en colonnes après l'en-tête : magic, nombre de mesures, mesures invalides en tête, crc32 des colonnes,
+# séquence suivant la dernière mesure (reprise au démarrage)
+SNAPSHOT_MAGIC = b'SNAP'
+SNAPSHOT_HEADER = '<4sIIIq'
+SNAPSHOT_HEADER_SIZE = struct.calcsize(SNAPSHOT_HEADER)
+# En-tête de bloc : marqueur, nombre d'enregistrements, crc32 des enregistrements
+BLOCK_HEADER = '<HHI'
+BLOCK_HEADER_SIZE = struct.calcsize(BLOCK_HEADER)
+BLOCK_MARKER = 0xB10C
+BLOCK_MAX_RECORDS = 256
+# Deux segments : l'actif reçoit les ajouts, l'autre est réécrit à la compaction
+JOURNAL_SEGMENTS = ('a', 'b')
+JOURNAL_DEFAULT_RECORDS = 1000  # Mesures gardées à la compaction, par défaut
+JOURNAL_FLASH_PERCENT = 10      # Part maximale (%) de l'espace flash libre occupée par le journal
+
+
+def write_columns(f, columns, itemsizes, slices, crc=0):
+    """
+    Écrit les tranches [start, end) de chaque colonne (array), colonne par colonne.
+    Chaque morceau est d'abord copié dans un buffer de travail, puis écrit et passé
+    au crc32 : le crc32 correspond aux octets écrits même si les arrays sont modifiés
+    pendant l'écriture. itemsizes : voir read_columns. Retourne le crc32 cumulé.
+    """
+    scratch = bytearray(512)
+    buf = memoryview(scratch)
+    for column, itemsize in zip(columns, itemsizes):
+        view = memoryview(column)
+        step = len(scratch) // itemsize
+        for start, end in slices:
+            for k in range(start, end, step):
+                items = min(step, end - k)
+                scratch[:items * itemsize] = view[k:k + items]
+                chunk = buf[:items * itemsize]
+                f.write(chunk)
+                crc = binascii.crc32(chunk, crc)
+    return crc
+
+
+def read_columns(f, columns, itemsizes, count, capacity, crc=0, first=0):
+    """
+    Lit count éléments par colonne avec readinto, directement dans les arrays : les
+    n = min(count, capacity) derniers vont aux index first, first + 1... (modulo capacity),
+    les plus anciens ne sont lus que pour le crc32. itemsizes : taille d'un élément de
+    chaque colonne ('q' : 8, 'f' : 4).
+    Retourne (n, crc32), ou (0, None) si le fichier est tronqué.
+    """
+    n = min(count, capacity)
+    end = min(first + n, capacity)
+    scratch = None
+    for column, itemsize in zip(columns, itemsizes):
+        view = memoryview(column)
+        skipped = (count - n) * itemsize
+        while skipped > 0:
+            if scratch is None:
+                scratch = bytearray(512)
+            chunk = memoryview(scratch)[:min(skipped, len(scratch))]
+            if f.readinto(chunk) != len(chunk):
+                return 0, None
+            crc = binascii.crc32(chunk, crc)
+            skipped -= len(chunk)
+        for chunk in (view[first:end], view[:first + n - end]):
+            if f.readinto(chunk) != len(chunk) * itemsize:
+                return 0, None
+            crc = binascii.crc32(chunk, crc)
+    return n, crc
+
+
+class Journal:
+    """
+    Journal binaire des mesures en ajout seul, sur deux segments A/B.
+    - Un segment commence par un snapshot en colonnes du buffer en RAM
+      (timestamps puis chaque champ, format natif des arrays, little-endian
+      sur ESP32), relu au démarrage avec readinto directement dans les arrays.
+    - Suivent des blocs d'enregistrements : timestamp ms 'q' puis n_values
+      floats ('<q' + 'f' * n_values). append() ajoute un bloc [marqueur, nombre,
+      crc32] + enregistrements puis flush : une coupure ne perd que le bloc en
+      cours d'écriture.
+    - Quand le segment actif dépasse max_records, compact() écrit un nouveau
+      snapshot dans l'autre segment. Sa génération n'est écrite qu'à la fin :
+      un segment incomplet (génération 0) est ignoré à la relecture.
+    - recover() relit le segment valide de plus haute génération : snapshot,
+      puis blocs jusqu'au premier bloc invalide (écriture interrompue).
+    Les écritures se font depuis le thread d'écriture (io_worker) uniquement.
+    """
+
+    def __init__(self, dir_path, n_values, max_records=2000):
+        self.dir_path = dir_path
+        self.n_values = n_values
+        self.record_format = '<q' + 'f' * n_values
+        self.record_size = struct.calcsize(self.record_format)
+        self.max_records = max_records
+        self.paths = {name: f"{dir_path}/journal_{name}.bin" for name in JOURNAL_SEGMENTS}
+        self.active = None      # Segment actif ('a' ou 'b')
+        self.generation = 0     # Génération du segment actif
+        self.file = None        # Fichier du segment actif, ouvert en écriture
+        self.records = 0        # Enregistrements dans le segment actif
+        # Statistiques
+        self.appends = 0
+        self.bytes = 0
+        self.compactions = 0
+        self.recovered = 0
+        self.corrupt = 0
+
+    def _read_header(self, f):
+        """Génération du segment, 0 si l'en-tête est absent, incomplet ou incompatible."""
+        header = f.read(JOURNAL_HEADER_SIZE)
+        if len(header) != JOURNAL_HEADER_SIZE:
+            return 0
+        magic, version, n_values, record_size, generation = struct.unpack(JOURNAL_HEADER, header)
+        if magic != JOURNAL_MAGIC or version != JOURNAL_VERSION:
+            return 0
+        if n_values != self.n_values or record_size != self.record_size:
+            log_warn(f"Journal : format différent ({n_values} valeurs), segment ignoré")
+            return 0
+        return generation
+
+    def _write_header(self, f, generation):
+        f.write(struct.pack(JOURNAL_HEADER, JOURNAL_MAGIC, JOURNAL_VERSION, self.n_values, self.record_size, generation))
+
+    def _scan(self, f, push=None):
+        """
+        Parcourt les blocs depuis la position courante jusqu'au premier bloc invalide.
+        push(entry) reçoit chaque enregistrement (timestamp, valeurs...).
+        Retourne (nombre d'enregistrements, position de fin des blocs valides).
+        """
+        record_size = self.record_size
+        record_format = self.record_format
+        count = 0
+        end = f.tell()
+        while True:
+            header = f.read(BLOCK_HEADER_SIZE)
+            if len(header) != BLOCK_HEADER_SIZE:
+                break
+            marker, nb_records, crc = struct.unpack(BLOCK_HEADER, header)
+            if marker != BLOCK_MARKER or not 0 < nb_records <= BLOCK_MAX_RECORDS:
+                self.corrupt += 1
+                break
+            payload = f.read(nb_records * record_size)
+            if len(payload) != nb_records * record_size or binascii.crc32(payload) != crc:
+                self.corrupt += 1
+                break
+            if push is not None:
+                for k in range(nb_records):
+                    push(struct.unpack_from(record_format, payload, k * record_size))
+            count += nb_records
+            end = f.tell()
+        return count, end
+
+    def recover(self, load_snapshot, push):
+        """
+        Relit le segment valide le plus récent et ouvre ce segment pour les ajouts suivants
+        (les éventuels octets d'un bloc interrompu seront écrasés).
+        load_snapshot(f, count, skip, crc, end_seq) lit le snapshot en colonnes (voir read_columns)
+        et retourne le nombre de mesures chargées, ou None si le crc32 est invalide ;
+        push(entry) reçoit ensuite chaque enregistrement des blocs.
+        Retourne le nombre de mesures relues.
+        """
+        best = None
+        for name in JOURNAL_SEGMENTS:
+            try:
+                with open(self.paths[name], 'rb') as f:
+                    generation = self._read_header(f)
+            except OSError:
+                continue
+            if generation > 0 and (best is None or generation > self.generation):
+                best = name
+                self.generation = generation
+        if best is None:
+            return 0
+
+        try:
+            f = open(self.paths[best], 'r+b')
+            f.seek(JOURNAL_HEADER_SIZE)
+            magic, snapshot_count, skip, crc, end_seq = struct.unpack(SNAPSHOT_HEADER, f.read(SNAPSHOT_HEADER_SIZE))
+            loaded = 0
+            if magic == SNAPSHOT_MAGIC and snapshot_count > 0:
+                loaded = load_snapshot(f, snapshot_count, skip, crc, end_seq)
+                if loaded is None:
+                    log_warn(f"Journal : snapshot invalide dans {self.paths[best]}")
+                    self.corrupt += 1
+                    loaded = 0
+            f.seek(JOURNAL_HEADER_SIZE + SNAPSHOT_HEADER_SIZE + snapshot_count * self.record_size)
+            count, end = self._scan(f, push)
+            f.seek(end)
+        except Exception as e:
+            log_err(f"Journal : erreur de relecture du segment {best} : {e}")
+            return 0
+        self.active = best
+        self.file = f
+        self.records = snapshot_count + count
+        self.recovered = loaded + count
+        log(f"✅ Journal : {loaded} + {count} mesures relues depuis {self.paths[best]} (génération {self.generation})")
+        return loaded + count
+
+    def _open_new(self, name, generation):
+        """Crée le segment name sans snapshot (génération 0 = incomplet) et retourne le fichier ouvert."""
+        f = open(self.paths[name], 'wb')
+        self._write_header(f, generation)
+        f.write(struct.pack(SNAPSHOT_HEADER, SNAPSHOT_MAGIC, 0, 0, 0, 0))
+        return f
+
+    def _write_block(self, f, payload):
+        f.write(struct.pack(BLOCK_HEADER, BLOCK_MARKER, len(payload) // self.record_size, binascii.crc32(payload)))
+        f.write(payload)
+
+    def append(self, payload):
+        """Ajoute les enregistrements de payload (au plus BLOCK_MAX_RECORDS) dans un bloc, puis flush."""
+        if not payload:
+            return
+        if self.file is None:
+            self.active = JOURNAL_SEGMENTS[0]
+            self.generation += 1
+            self.file = self._open_new(self.active, self.generation)
+            self.records = 0
+        self._write_block(self.file, payload)
+        self.file.flush()
+        self.records += len(payload) // self.record_size
+        self.appends += 1
+        self.bytes += BLOCK_HEADER_SIZE + len(payload)
+
+    def records_for_flash(self, records, percent=JOURNAL_FLASH_PERCENT):
+        """
+        Mesures gardées à la compaction, réduites pour que le journal tienne dans percent %
+        de l'espace flash libre (segments actuels compris). Au pire, juste avant que l'ancien
+        segment soit réécrit : ancien segment (2 × records) + nouveau snapshot (records).
+        Au moins BLOCK_MAX_RECORDS.
+        """
+        try:
+            stat = os.statvfs(self.dir_path)
+        except OSError:
+            return records
+        free = stat[0] * stat[3]
+        for path in self.paths.values():
+            try:
+                free += os.stat(path)[6]
+            except OSError:
+                pass
+        limit = max(BLOCK_MAX_RECORDS, free * percent // 100 // (3 * self.record_size))
+        if records > limit:
+            log_warn(f"Journal : {records} mesures demandées, limité à {limit} ({percent}% de la flash libre)")
+            return limit
+        return records
+
+    def needs_compaction(self):
+        return self.records >= self.max_records
+
+    def compact(self, write_snapshot):
+        """
+        Réécrit le journal dans l'autre segment, qui devient le segment actif.
+        write_snapshot(f) écrit les colonnes du snapshot (voir write_columns)
+        et retourne (nombre de mesures, mesures invalides en tête, crc32, séquence suivant la dernière mesure).
+        """
+        target = JOURNAL_SEGMENTS[1] if self.active == JOURNAL_SEGMENTS[0] else JOURNAL_SEGMENTS[0]
+        f = self._open_new(target, 0)
+        try:
+            records, skip, crc, end_seq = write_snapshot(f)
+            self.bytes += SNAPSHOT_HEADER_SIZE + records * self.record_size
+            # Segment complet : en-tête du snapshot puis génération, qui le rend valide
+            f.flush()
+            f.seek(0)
+            self._write_header(f, self.generation + 1)
+            f.write(struct.pack(SNAPSHOT_HEADER, SNAPSHOT_MAGIC, records, skip, crc, end_seq))
+            f.flush()
+            f.seek(0, 2)
+        except Exception:
+            f.close()
+            raise
+        if self.file is not None:
+            self.file.close()
+        self.file = f
+        self.active = target
+        self.generation += 1
+        self.records = records
+        self.compactions += 1
+        log(f"✅ Journal compacté : snapshot de {records - skip} mesures → {self.paths[target]} (génération {self.generation})")
+
+    def stats(self):
+        return {
+            'segment': self.active,
+            'generation': self.generation,
+            'records': self.records,
+            'appends': self.appends,
+            'bytes': self.bytes,
+            'compactions': self.compactions,
+            'recovered': self.recovered,
+            'corrupt': self.corrupt,
+        }
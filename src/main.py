@@ -7,40 +7,159 @@ import esp32
 import gc
 import machine
 
-from ina3221 import INA3221
-from dataHist import DataHist
+from acquisition import Acquisition, AdaptiveRate, BurstCapture
+from i2cBus import I2C_FREQS
+from dataHist import DataHist, size_from_budget
+from aggregates import AggregateFile, AGGREGATE_SUFFIX, INDEX_SUFFIX
+from retention import Retention
+from history import history_json, parse_fields, parse_bucket
+from scheduler import Scheduler
+from ioWorker import io_worker
 from env import env
 from wifi import wifi
-from tools import get_mime_type, parse_iso_date_str, get_rtc_datetime_str, format_memory
+from tools import get_mime_type, parse_iso_date_str, datetime_to_epoch_ms, get_timestamp_from_rtc_datetime, get_rtc_datetime_str, format_memory, parse_form_urlencoded, parse_int_list, json_array_chunks
 from logger import log, log_warn, log_err, get_logs
 
 app = Microdot()
-ina = INA3221(addr=0x40)
-data = DataHist()
+io_worker.configure(
+    max_jobs=int(env.get('IO_QUEUE_SIZE', 8)),
+    overflow=env.get('IO_OVERFLOW_POLICY', 'drop_oldest')
+)
+# INA3221_ADDRESSES: comma separated I2C addresses (ex. "0x40,0x41"), auto-discovery with i2c.scan() if unset
+ina_addresses = env.get('INA3221_ADDRESSES')
+# I2C_FREQS: candidate bus frequencies in Hz, the fastest stable one is kept
+i2c_freqs = env.get('I2C_FREQS')
+acq = Acquisition(
+    addrs=[int(addr, 0) for addr in str(ina_addresses).split(',')] if ina_addresses else None,
+    freqs=parse_int_list(i2c_freqs) if i2c_freqs else I2C_FREQS
+)
+tier_sizes = {
+    '10s': int(env.get('DATAHIST_10S_SIZE', 360)),
+    '1m': int(env.get('DATAHIST_1M_SIZE', 360)),
+    '1h': int(env.get('DATAHIST_1H_SIZE', 168)),
+}
+# DATAHIST_MEMORY_BUDGET: % of free RAM (PSRAM included) for the history, overrides DATAHIST_MAX_SIZE
+datahist_size = int(env.get('DATAHIST_MAX_SIZE', 1000))
+memory_budget = env.get('DATAHIST_MEMORY_BUDGET')
+if memory_budget:
+    datahist_size, budget_bytes = size_from_budget(float(str(memory_budget).rstrip('%')), acq.n_channels, tier_sizes)
+    log(f"DataHist : {datahist_size} mesures ({memory_budget}% de la RAM libre = {budget_bytes} octets)")
+# RETENTION_FLASH_BUDGET: % of the flash for ./data - RETENTION_MAX_AGE_DAYS: 0 = keep forever
+retention = Retention(
+    './data',
+    budget_percent=int(env.get('RETENTION_FLASH_BUDGET', 80)),
+    max_age_days=int(env.get('RETENTION_MAX_AGE_DAYS', 0)),
+    compress_after_days=int(env.get('RETENTION_COMPRESS_AFTER_DAYS', 1))
+)
+# API_DATA_LIMIT: default max entries returned by /api/data (?limit= to override)
+api_data_limit = int(env.get('API_DATA_LIMIT', 1000))
+# JOURNAL_FLUSH_S: seconds between two journal blocks (data lost on power cut)
+# JOURNAL_MAX_RECORDS: samples kept by the journal (1000 by default), capped to 10% of the free flash
+data = DataHist(
+    max_size=datahist_size,
+    n_channels=acq.n_channels,
+    tier_sizes=tier_sizes,
+    journal_flush_s=float(env.get('JOURNAL_FLUSH_S', 5)),
+    journal_records=int(env.get('JOURNAL_MAX_RECORDS', 0)) or None,
+    # AGGREGATE_BATCH_ROWS: minute rows per flash write - AGGREGATE_FSYNC: batch, hour or none
+    aggregate_batch_rows=int(env.get('AGGREGATE_BATCH_ROWS', 10)),
+    aggregate_fsync=env.get('AGGREGATE_FSYNC', 'batch'),
+    retention=retention,
+)
+capture = BurstCapture(acq, dir_path=data.dir_path)
+adaptive = None
+if env.get('ACQUISITION_ADAPTIVE', False):
+    adaptive = AdaptiveRate(
+        dv_dt=float(env.get('ADAPTIVE_DV_DT', 0.01)),
+        di_dt=float(env.get('ADAPTIVE_DI_DT', 0.05)),
+        max_decimation=int(env.get('ADAPTIVE_MAX_DECIMATION', 16))
+    )
+scheduler = Scheduler(
+    freq=int(env.get('ACQUISITION_FREQ', 1)),
+    policy=env.get('ACQUISITION_OVERRUN_POLICY', 'skip')
+)
+
+# INA3221 configuration keys: .env key -> (form field, INA3221.configure() argument)
+INA_CONFIG_KEYS = {
+    'INA3221_AVG': ('avg', 'avg'),
+    'INA3221_VBUS_CT': ('vbus_ct', 'vbus_ct_us'),
+    'INA3221_VSH_CT': ('vsh_ct', 'vsh_ct_us'),
+    'INA3221_MODE': ('mode', 'mode'),
+    'INA3221_CHANNELS': ('channels', 'channels'),
+}
+
+def ina_config_args(values):
+    """Convert {.env key: value} to INA3221.configure() keyword arguments."""
+    kwargs = {}
+    for key, (_, arg) in INA_CONFIG_KEYS.items():
+        value = values.get(key)
+        if value is None or value == '':
+            continue
+        if arg == 'channels':
+            value = parse_int_list(value)
+        elif arg != 'mode':
+            value = int(value)
+        kwargs[arg] = value
+    return kwargs
+
+# Time kept free before each deadline when a burst capture is running (µs)
+BURST_MARGIN_US = 2000
 
 # Function to collect sensor data in a separate thread
 def sensor_loop():
-    target_period = 1.0 / int(env.get('ACQUISITION_FREQ', 1))
+    overruns = 0
+    # 'timer': ACQUISITION_FREQ deadlines - 'ready': follow the INA3221 conversion rate
+    mode = env.get('ACQUISITION_MODE', 'timer')
+    last_ready = None
+    if mode == 'ready':
+        acq.set_continuous()
+    scheduler.start()
     while True:
-        start_time = time.ticks_ms()  # Get current time in milliseconds
-        # Read values from each channel
-        v1 = ina.get_bus_voltage(0)
-        a1 = ina.get_current(0)
-        v2 = ina.get_bus_voltage(1)
-        a2 = ina.get_current(1)
-        v3 = ina.get_bus_voltage(2)
-        a3 = ina.get_current(2)
-        
-       
-        data.add(v1, a1, v2, a2, v3, a3)
-        
-        elapsed_time = time.ticks_diff(time.ticks_ms(), start_time) / 1000.0
-        
-        if target_period - elapsed_time < 0:
-            log_warn("Freq too high")
-            
-        sleep_time = max(0, target_period - elapsed_time)
-        time.sleep(sleep_time)
+        try:
+            if mode == 'ready':
+                # Read only once a new conversion cycle is complete
+                if not acq.wait_conversion_ready(since_us=last_ready):
+                    log_warn("Conversion ready timeout")
+                    last_ready = None
+                    continue
+                last_ready = time.ticks_us()
+            else:
+                # Burst capture uses the idle time before the next deadline
+                while capture.active and scheduler.remaining_us() > BURST_MARGIN_US:
+                    capture.step()
+                # Wait for the next absolute deadline (no drift)
+                scheduler.wait()
+                if scheduler.overruns != overruns:
+                    overruns = scheduler.overruns
+                    log_warn(f"Freq too high - overruns: {overruns} skipped: {scheduler.skipped}")
+
+            # Read all channels registers of all devices in one pass
+            values = acq.read()
+            acq.sample_ok()
+            # Effective acquisition rate (Hz)
+            if mode == 'ready':
+                rate = 1000000 / acq.primary.conversion_period_us
+            else:
+                rate = scheduler.freq
+
+            # Adaptive mode: flat signal samples are decimated
+            if adaptive is not None:
+                if not adaptive.update(values, time.ticks_us(), rate):
+                    continue
+                rate = adaptive.rate
+
+            # Global current from the hardware shunt sum register (one read)
+            a = acq.get_global_current()
+        except OSError as e:
+            # I2C error, already counted by the bus (frequency step-down): sample missed,
+            # the scheduler keeps its deadlines
+            last_ready = None
+            if acq.missed_sample(e):
+                log_err("Capteurs injoignables après plusieurs réinitialisations du bus, redémarrage")
+                machine.reset()
+            continue
+
+        data.add(values, a, rate)
 
 
 @app.after_error_request
@@ -67,7 +186,7 @@ def api_status(request):
         'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
         'Access-Control-Allow-Headers': 'Content-Type',
     }
-    devices = ina.i2c.scan()
+    devices = acq.i2c.scan()
     
     # --- RAM ---
     ram_used = gc.mem_alloc()
@@ -104,19 +223,147 @@ def api_status(request):
         }, 
         'sensor':{
             'loopFreq': env.get('ACQUISITION_FREQ',1),
-            'ina3221.address': hex(ina.addr),
-            'ina3221.id': hex(ina.get_manuf_id()),
-            'i2c.scan': [hex(device) for device in devices]
+            'mode': env.get('ACQUISITION_MODE', 'timer'),
+            'scheduler': scheduler.stats(),
+            'adaptive': adaptive.stats() if adaptive is not None else None,
+            'ina3221.address': hex(acq.primary.addr),
+            'ina3221.addresses': [hex(device.addr) for device in acq.devices],
+            'ina3221.id': hex(acq.primary.get_manuf_id()),
+            'channels': acq.n_channels,
+            'i2c.scan': [hex(device) for device in devices],
+            'i2c.bus': acq.bus.stats(),
+            'acquisition': acq.stats()
         },
+        'io': io_worker.stats(),
+        'history': data.stats(),
         'memory': {
             'ram': format_memory(ram_used, ram_total),
             'storage': format_memory(storage_used, storage_total),
-            'psram': psram_str
+            'psram': psram_str,
+            'retention': retention.stats()
         }
     }
 
     return Response(json.dumps(response), headers=response_headers)
 
+@app.get('/api/sensor/config')
+def api_sensor_config(request):
+    response_headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+    }
+    return Response(json.dumps(acq.primary.get_config()), headers=response_headers)
+
+@app.post('/api/sensor/config')
+def api_sensor_config_update(request):
+    response_headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+    }
+
+    content_type = request.headers.get('Content-Type', '')
+    if 'application/x-www-form-urlencoded' not in content_type:
+        return Response(
+            json.dumps({'error': 'Content-Type non supporté'}),
+            status_code=415,
+            headers=response_headers
+        )
+
+    try:
+        form = parse_form_urlencoded(request.body.decode('utf-8'))
+        values = {}
+        for key, (field, _) in INA_CONFIG_KEYS.items():
+            if form.get(field):
+                values[key] = form[field]
+
+        # Apply first: invalid values raise ValueError and are not saved
+        config = acq.configure(**ina_config_args(values))
+        for key, value in values.items():
+            env.set(key, value)
+        return Response(json.dumps(config), headers=response_headers)
+
+    except ValueError as e:
+        return Response(
+            json.dumps({'error': f'Erreur: {str(e)}'}),
+            status_code=400,
+            headers=response_headers
+        )
+    except Exception as e:
+        log_err(f"Erreur dans api_sensor_config_update: {e}")
+        return Response(
+            json.dumps({'error': f'Erreur interne: {str(e)}'}),
+            status_code=500,
+            headers=response_headers
+        )
+
+@app.get('/api/capture')
+def api_capture(request):
+    response_headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+    }
+    response_data = capture.status()
+    try:
+        response_data['files'] = sorted([f for f in os.listdir(data.dir_path) if f.startswith('capture_')], reverse=True)
+    except OSError:
+        response_data['files'] = []
+    return Response(json.dumps(response_data), headers=response_headers)
+
+@app.post('/api/capture')
+def api_capture_arm(request):
+    response_headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+    }
+
+    if env.get('ACQUISITION_MODE', 'timer') != 'timer':
+        return Response(
+            json.dumps({'error': 'Capture disponible uniquement en ACQUISITION_MODE=timer'}),
+            status_code=409,
+            headers=response_headers
+        )
+
+    try:
+        form = parse_form_urlencoded(request.body.decode('utf-8'))
+        threshold = form.get('threshold')
+        delta = form.get('delta')
+        capture.arm(
+            fields=form.get('fields', 'a1').split(','),
+            pre=int(form.get('pre', 200)),
+            post=int(form.get('post', 800)),
+            threshold=float(threshold) if threshold else None,
+            delta=float(delta) if delta else None,
+        )
+        return Response(json.dumps(capture.status()), headers=response_headers)
+
+    except ValueError as e:
+        return Response(
+            json.dumps({'error': f'Erreur: {str(e)}'}),
+            status_code=400,
+            headers=response_headers
+        )
+    except Exception as e:
+        log_err(f"Erreur dans api_capture_arm: {e}")
+        return Response(
+            json.dumps({'error': f'Erreur interne: {str(e)}'}),
+            status_code=500,
+            headers=response_headers
+        )
+
+@app.delete('/api/capture')
+def api_capture_cancel(request):
+    response_headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+    }
+    capture.cancel()
+    return Response(json.dumps(capture.status()), headers=response_headers)
+
 @app.get('/api/logs')
 def api_logs(request):
     response_headers = {
@@ -218,17 +465,38 @@ def api_data(request):
         }
     
     try:    
-        response_data = []
+        # ?from= / ?to= : ISO dates, ?last= : number of seconds before now
+        # ?resolution= : raw (default), 10s, 1m or 1h (min / avg / max per bucket)
+        # ?seq= : raw samples with a sequence number > seq only (incremental polling)
+        # ?limit= : at most limit entries, the newest ones (the oldest after seq), API_DATA_LIMIT by default
         from_date_str = request.args.get('from', None)
-        
+        to_date_str = request.args.get('to', None)
+        last_str = request.args.get('last', None)
+        resolution = request.args.get('resolution', 'raw')
+        seq_str = request.args.get('seq', None)
+        limit = int(request.args.get('limit', api_data_limit))
+
+        from_ms = None
+        to_ms = None
         if from_date_str is not None:
-            from_date = parse_iso_date_str(from_date_str)
-            response_data = data.all_after(from_date)
-        else:
-            response_data = data.all()
-                
-        return Response(json.dumps(response_data), headers=response_headers)
+            from_ms = datetime_to_epoch_ms(*parse_iso_date_str(from_date_str))
+        if to_date_str is not None:
+            to_ms = datetime_to_epoch_ms(*parse_iso_date_str(to_date_str))
+        if last_str is not None:
+            last_ms = get_timestamp_from_rtc_datetime() - int(float(last_str) * 1000)
+            from_ms = last_ms if from_ms is None else max(from_ms, last_ms)
 
+        entries = data.iter_between(from_ms, to_ms, resolution, int(seq_str) if seq_str is not None else None, limit)
+        # JSON streamed entry by entry, serialized outside the lock
+        response_headers['Content-Type'] = 'application/json'
+        return Response(body=json_array_chunks(entries), headers=response_headers)
+
+    except ValueError as e:
+        return Response(
+            json.dumps({'error': f'Erreur: {str(e)}'}),
+            status_code=400,
+            headers=response_headers
+        )
     except Exception as e: 
         log_err("Erreur dans api_data:", e)
         return Response(
@@ -238,6 +506,51 @@ def api_data(request):
         )
 
 
+@app.get('/api/history')
+def api_history(request):
+    response_headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type',
+        }
+
+    try:
+        # ?from= (required) / ?to= (default now) : ISO dates, read from the daily aggregate files
+        # ?fields= : comma separated columns (avg_v1,ws1,...), all by default
+        # ?bucket= : seconds per bucket, multiple of 60 (default 60)
+        from_date_str = request.args.get('from', None)
+        to_date_str = request.args.get('to', None)
+        if from_date_str is None:
+            raise ValueError("Missing parameter: from")
+        from_ms = datetime_to_epoch_ms(*parse_iso_date_str(from_date_str))
+        if to_date_str is not None:
+            to_ms = datetime_to_epoch_ms(*parse_iso_date_str(to_date_str))
+        else:
+            to_ms = get_timestamp_from_rtc_datetime()
+        if to_ms <= from_ms:
+            raise ValueError("Invalid range: to must be after from")
+        fields = parse_fields(request.args.get('fields', None), acq.n_channels)
+        bucket_s = parse_bucket(request.args.get('bucket', 60))
+
+        # JSON streamed bucket by bucket (one bucket and one file block in RAM)
+        response_headers['Content-Type'] = 'application/json'
+        return Response(body=history_json(data.dir_path, from_ms, to_ms, fields, bucket_s), headers=response_headers)
+
+    except ValueError as e:
+        return Response(
+            json.dumps({'error': f'Erreur: {str(e)}'}),
+            status_code=400,
+            headers=response_headers
+        )
+    except Exception as e:
+        log_err("Erreur dans api_history:", e)
+        return Response(
+            json.dumps({'error': f'Erreur: {str(e)}'}),
+            status_code=500,
+            headers=response_headers
+        )
+
+
 @app.get('/api/files')
 def api_files(request):
     response_headers = {
@@ -251,10 +564,19 @@ def api_files(request):
         response_data = []
         base_url = request.headers.get('host', 'localhost')  # Get host from request
         for filename in files:
+            if filename.endswith('.tmp') or filename.endswith(INDEX_SUFFIX):
+                continue
+            size = os.stat(f'./data/{filename}')[6]  # Size in bytes
+            if filename.endswith(f'{AGGREGATE_SUFFIX}.bin'):
+                # Binary daily aggregates are downloaded as CSV, generated on the fly
+                filename = filename[:-len('bin')] + 'csv'
+            elif filename.endswith('.gz'):
+                # Compressed days are sent as is with Content-Encoding: gzip
+                filename = filename[:-len('.gz')]
             response_data.append({
                 'filename': filename,
                 'url': f"http://{base_url}/files/{filename}",
-                'size': os.stat(f'./data/{filename}')[6]  # Size in bytes
+                'size': size
             })
         return Response(json.dumps(response_data), headers=response_headers)
     except Exception as e:
@@ -275,16 +597,35 @@ def file_download(request, filename):
     }
     try:
         filepath = f'./data/{filename}'
+        if filename.endswith(f'{AGGREGATE_SUFFIX}.csv'):
+            binpath = filepath[:-len('csv')] + 'bin'
+            try:
+                aggregate = AggregateFile.load(binpath)
+            except OSError:
+                aggregate = None
+            if aggregate is not None:
+                # CSV streamed row by row from the binary file (one block in RAM)
+                response_headers['Content-Type'] = 'text/csv'
+                response_headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+                return Response(body=aggregate.csv(), headers=response_headers)
+        compressed = False
         try:
             os.stat(filepath)  # Check file existence
         except OSError:
-            return Response(
-                {'error': f'Fichier {filename} non trouvé'},
-                status_code=404,
-                headers=response_headers
-            )
+            try:
+                os.stat(filepath + '.gz')  # Compressed by the retention manager
+                compressed = True
+            except OSError:
+                return Response(
+                    {'error': f'Fichier {filename} non trouvé'},
+                    status_code=404,
+                    headers=response_headers
+                )
         # Get the file response
-        file_response = send_file(filepath)
+        if compressed:
+            file_response = send_file(filepath, compressed=True, file_extension='.gz')
+        else:
+            file_response = send_file(filepath)
         # Merge headers manually
         combined_headers = file_response.headers.copy()  # Copy headers from send_file
         combined_headers.update(response_headers)  # Add CORS headers
@@ -332,20 +673,24 @@ def serve_static(request, filepath=None):
 if __name__ == '__main__':
     for attempt in range(3):
         try:
-            ina.reset()
+            acq.reset()
+            acq.configure(**ina_config_args(env.data))
+            sum_channels = parse_int_list(env.get('INA3221_SUM_CHANNELS', '1,2,3'))
+            if sum_channels:
+                acq.set_summation(sum_channels)
             _thread.start_new_thread(sensor_loop, ())
             env.set('SENSOR_LOOP', True)
             break
         except Exception as e:
             
             log('Scan I2C devices...')
-            devices = ina.i2c.scan()
+            devices = acq.i2c.scan()
             if devices:
                 log('Devices found:', devices)
             else:
                 log('No I2C devices found.')
 
-            has_reset = ina.reset_i2c()
+            has_reset = acq.reset_i2c()
             log_err(f"Erreur start sensor_loop - has_reset: {has_reset} - err: {e}")
             time.sleep(2 ** attempt)
             
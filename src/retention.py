@@ -0,0 +1,351 @@
+import os
+import time
+
+try:
+    import deflate
+except ImportError:  # Firmware sans module deflate : pas de compression
+    deflate = None
+
+from aggregates import AggregateFile, AGGREGATE_SUFFIX, INDEX_SUFFIX, DAY_MS
+from tools import days_from_civil, datetime_to_iso_str
+from logger import log, log_warn, log_err
+
+RETENTION_PERIOD_MS = 3600000   # Passage du gestionnaire : une fois par heure
+DEFLATE_WBITS = 10              # Fenêtre de compression de 1 Ko
+DOWNSAMPLE_MINUTES = 15
+DOWNSAMPLE_SUFFIX = f'_daily_{DOWNSAMPLE_MINUTES}_minute_aggregate'
+TREND_SAMPLES = 24              # Mesures d'espace libre gardées pour la tendance (une par passage)
+
+
+def day_of_file(name):
+    """Jour (depuis 1970) d'un fichier journalier 'YYYY-MM-DD_...', None pour les autres fichiers."""
+    if len(name) < 11 or name[10] != '_' or name[4] != '-' or name[7] != '-':
+        return None
+    try:
+        return days_from_civil(int(name[0:4]), int(name[5:7]), int(name[8:10]))
+    except ValueError:
+        return None
+
+
+def read_lines(path, offset=0):
+    """Générateur des lignes d'un fichier texte, décompressé à la volée si .gz, sinon à partir de l'octet offset."""
+    with open(path, 'rb') as f:
+        if offset and not path.endswith('.gz'):
+            f.seek(offset)
+        stream = deflate.DeflateIO(f, deflate.GZIP) if path.endswith('.gz') else f
+        while True:
+            line = stream.readline()
+            if not line:
+                break
+            yield line.decode()
+
+
+def gzip_lines(path, lines):
+    """Écrit les lignes compressées (gzip) dans path, via un fichier temporaire renommé à la fin."""
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            with deflate.DeflateIO(f, deflate.GZIP, DEFLATE_WBITS) as stream:
+                for line in lines:
+                    stream.write(line.encode())
+        os.rename(tmp_path, path)
+    except Exception:
+        # Flash pleine ou source illisible : pas de fichier partiel laissé
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def compressed_name(name):
+    """Nom compressé d'un fichier journalier, None s'il n'est pas à compresser."""
+    if name.endswith(f'{AGGREGATE_SUFFIX}.bin'):
+        return name[:-len('bin')] + 'csv.gz'
+    if name.endswith('.txt') or name.endswith('.csv'):
+        return name + '.gz'
+    return None
+
+
+def downsample_lines(lines):
+    """
+    Lignes CSV d'agrégats par minute (date;avg_v1;avg_a1;ws1;...;avg_a) regroupées
+    par DOWNSAMPLE_MINUTES minutes : moyenne des colonnes avg_, somme des colonnes ws.
+    """
+    header = None
+    is_ws = None
+    bucket = None
+    sums = None
+    count = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        fields = line.split(';')
+        if header is None:
+            header = line
+            is_ws = [name.startswith('ws') for name in fields[1:]]
+            yield header + "\n"
+            continue
+        date = fields[0]
+        hour = int(date[11:13])
+        minute = int(date[14:16])
+        start = (hour * 60 + minute) // DOWNSAMPLE_MINUTES * DOWNSAMPLE_MINUTES
+        if start != bucket:
+            if count > 0:
+                yield _downsampled_line(bucket_date, bucket, sums, count, is_ws)
+            bucket = start
+            bucket_date = date
+            sums = [0.0] * len(is_ws)
+            count = 0
+        for k, value in enumerate(fields[1:]):
+            sums[k] += float(value)
+        count += 1
+    if count > 0:
+        yield _downsampled_line(bucket_date, bucket, sums, count, is_ws)
+
+
+def _downsampled_line(date, start, sums, count, is_ws):
+    line = datetime_to_iso_str(int(date[0:4]), int(date[5:7]), int(date[8:10]), start // 60, start % 60, 0)
+    for value, ws in zip(sums, is_ws):
+        line += f";{value:.4f}" if ws else f";{value / count:.3f}"
+    return line + "\n"
+
+
+class Retention:
+    """
+    Gestion de l'espace flash de dir_path, une fois par heure depuis le thread d'écriture :
+    - âge : les jours de plus de max_age_days sont supprimés (0 = jamais) ;
+    - budget : tant que dir_path dépasse budget_percent % de la flash, les captures
+      (capture_*.bin) sont supprimées de la plus ancienne à la plus récente, puis les
+      jours les plus anciens sont réduits à un agrégat par DOWNSAMPLE_MINUTES minutes,
+      puis supprimés ;
+    - compression : les jours terminés depuis compress_after_days sont compressés
+      (gzip, module deflate) : agrégats binaires → CSV .csv.gz, texte → .txt.gz,
+      servis tels quels avec Content-Encoding: gzip ;
+    - tendance : espace libre à chaque passage, pente en octets par heure.
+    Les suppressions passent avant la compression : elles ne demandent pas d'espace libre.
+    Un fichier en erreur (illisible, flash pleine) est ignoré, le passage continue.
+    Le passage avance d'un fichier compressé ou réduit par appel de tick() (une fois
+    par minute) : le thread d'écriture n'est jamais occupé plus d'un fichier à la fois.
+    Le jour en cours n'est jamais modifié.
+    """
+
+    def __init__(self, dir_path, budget_percent=80, max_age_days=0, compress_after_days=1):
+        if not 0 < budget_percent <= 100:
+            raise ValueError(f"Invalid flash budget: {budget_percent} - expected 0 < percent <= 100")
+        self.dir_path = dir_path
+        self.budget_percent = budget_percent
+        self.max_age_days = max_age_days
+        self.compress_after_days = max(1, compress_after_days)
+        self.last_run_ms = None
+        self.work = None  # Passage en cours (générateur de _steps)
+        self.used = 0
+        self.budget = 0
+        self.trend = []  # (time.time(), octets libres)
+        # Statistiques
+        self.runs = 0
+        self.compressed = 0
+        self.downsampled = 0
+        self.deleted = 0
+        self.captures_deleted = 0
+        self.failed = 0
+        if deflate is None:
+            log_warn("Retention : module deflate absent, pas de compression")
+
+    def tick(self, now_ms):
+        """
+        Avance le passage en cours d'un fichier, ou lance un passage si le précédent
+        a commencé il y a plus de RETENTION_PERIOD_MS.
+        """
+        if self.work is None:
+            if self.last_run_ms is not None and now_ms - self.last_run_ms < RETENTION_PERIOD_MS:
+                return
+            self.last_run_ms = now_ms
+            self.work = self._steps(now_ms)
+        try:
+            next(self.work)
+        except StopIteration:
+            self.work = None
+        except Exception as e:
+            self.work = None
+            log_err(f"Retention : erreur : {e}")
+
+    def run(self, now_ms):
+        """Passage complet en une fois (outil, REPL)."""
+        for _ in self._steps(now_ms):
+            pass
+
+    def _scan(self):
+        """
+        Fichiers journaliers par jour {jour: [noms]}, captures de la plus ancienne à la plus
+        récente (noms datés) et taille totale de dir_path. Retourne (jours, captures).
+        """
+        days = {}
+        captures = []
+        self.used = 0
+        for name in os.listdir(self.dir_path):
+            if name.endswith('.tmp'):
+                # Compression interrompue (coupure)
+                try:
+                    os.remove(f"{self.dir_path}/{name}")
+                except OSError:
+                    pass
+                continue
+            try:
+                self.used += os.stat(f"{self.dir_path}/{name}")[6]
+            except OSError:
+                continue
+            day = day_of_file(name)
+            if day is not None:
+                days.setdefault(day, []).append(name)
+            elif name.startswith('capture_'):
+                captures.append(name)
+        captures.sort()
+        return days, captures
+
+    def _remove(self, name, missing_ok=False):
+        path = f"{self.dir_path}/{name}"
+        try:
+            size = os.stat(path)[6]
+        except OSError as e:
+            if not missing_ok:
+                log_err(f"Retention : suppression de {name} impossible : {e}")
+            return
+        try:
+            os.remove(path)
+            self.used -= size
+        except OSError as e:
+            log_err(f"Retention : suppression de {name} impossible : {e}")
+
+    def _replace(self, names, new_name, lines):
+        """Écrit new_name (gzip) depuis lines puis supprime names."""
+        gzip_lines(f"{self.dir_path}/{new_name}", lines)
+        self.used += os.stat(f"{self.dir_path}/{new_name}")[6]
+        for name in names:
+            self._remove(name)
+
+    def _compress(self, name):
+        """Compresse un fichier journalier non compressé, retourne le nouveau nom (None si rien à faire ou erreur)."""
+        path = f"{self.dir_path}/{name}"
+        new_name = compressed_name(name)
+        if new_name is None:
+            return None
+        try:
+            if name.endswith('.bin'):
+                self._replace([name], new_name, AggregateFile.load(path).csv())
+            else:
+                self._replace([name], new_name, read_lines(path))
+        except Exception as e:
+            self.failed += 1
+            log_err(f"Retention : compression de {name} impossible, fichier ignoré : {e}")
+            return None
+        # L'index des offsets ne vaut pas pour le fichier compressé (lu depuis le début)
+        self._remove(name + INDEX_SUFFIX, missing_ok=True)
+        self.compressed += 1
+        log(f"✅ Retention : {name} compressé → {new_name}")
+        return new_name
+
+    def _downsample(self, names):
+        """Réduit un jour à un agrégat par DOWNSAMPLE_MINUTES minutes, retourne False si déjà fait."""
+        source = None
+        for name in names:
+            if DOWNSAMPLE_SUFFIX in name:
+                return False
+            # Agrégat principal du jour (pas un fichier mis de côté 'YYYY-MM-DD_<n>ch_...')
+            if name[10:].startswith(AGGREGATE_SUFFIX) and name.endswith('.gz'):
+                source = name
+        if source is None:
+            return False
+        new_name = source[:10] + DOWNSAMPLE_SUFFIX + '.csv.gz'
+        try:
+            self._replace([source], new_name, downsample_lines(read_lines(f"{self.dir_path}/{source}")))
+        except Exception as e:
+            self.failed += 1
+            log_err(f"Retention : réduction de {source} impossible, fichier ignoré : {e}")
+            return False
+        self.downsampled += 1
+        log(f"✅ Retention : {source} réduit → {new_name}")
+        return True
+
+    def _steps(self, now_ms):
+        """Générateur d'un passage : s'interrompt après chaque fichier compressé ou réduit."""
+        today = now_ms // DAY_MS
+        days, captures = self._scan()
+        stat = os.statvfs(self.dir_path)
+        self.budget = stat[0] * stat[2] * self.budget_percent // 100
+
+        # Âge (hors jour en cours)
+        if self.max_age_days:
+            for day in sorted(days):
+                if today - day > self.max_age_days:
+                    names = days.pop(day)
+                    for name in names:
+                        self._remove(name)
+                    self.deleted += 1
+                    log(f"✅ Retention : jour de plus de {self.max_age_days} jours supprimé ({names[0][:10]})")
+
+        # Budget : suppression des captures, puis réduction et suppression des jours les plus anciens (hors jour en cours)
+        for name in captures:
+            if self.used <= self.budget:
+                break
+            self._remove(name)
+            self.captures_deleted += 1
+            log_warn(f"Retention : budget flash dépassé, capture supprimée ({name})")
+        old_days = [day for day in sorted(days) if day < today]
+        if self.used > self.budget and deflate is not None:
+            for day in old_days:
+                if self.used <= self.budget:
+                    break
+                if self._downsample(days[day]):
+                    yield
+        for day in old_days:
+            if self.used <= self.budget:
+                break
+            for name in os.listdir(self.dir_path):
+                if day_of_file(name) == day:
+                    self._remove(name)
+            self.deleted += 1
+            log_warn(f"Retention : budget flash dépassé, jour supprimé ({days.pop(day)[0][:10]})")
+
+        # Compression des jours restants
+        if deflate is not None:
+            for day in sorted(days):
+                if today - day >= self.compress_after_days:
+                    for name in days[day]:
+                        if compressed_name(name) is not None:
+                            self._compress(name)
+                            yield
+
+        stat = os.statvfs(self.dir_path)
+        self.trend.append((time.time(), stat[0] * stat[4]))
+        if len(self.trend) > TREND_SAMPLES:
+            self.trend.pop(0)
+        self.runs += 1
+
+    def stats(self):
+        free = self.trend[-1][1] if self.trend else None
+        slope = None
+        full_in_hours = None
+        if len(self.trend) >= 2:
+            (t0, free0), (t1, free1) = self.trend[0], self.trend[-1]
+            if t1 > t0:
+                slope = int((free1 - free0) * 3600 / (t1 - t0))
+                if slope < 0:
+                    full_in_hours = round(free1 / -slope, 1)
+        return {
+            'budget': self.budget,
+            'used': self.used,
+            'free': free,
+            'freeTrend.bytesPerHour': slope,
+            'fullInHours': full_in_hours,
+            'maxAgeDays': self.max_age_days,
+            'compression': deflate is not None,
+            'runs': self.runs,
+            'compressed': self.compressed,
+            'downsampled': self.downsampled,
+            'deleted': self.deleted,
+            'capturesDeleted': self.captures_deleted,
+            'failed': self.failed,
+            'running': self.work is not None,
+        }
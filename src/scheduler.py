@@ -0,0 +1,111 @@
+import time
+
+# Politiques en cas de dépassement d'échéance
+POLICY_SKIP = 'skip'        # Saute les échéances manquées, reste aligné sur la grille
+POLICY_CATCHUP = 'catchup'  # Enchaîne les échéances manquées sans attente
+
+# Bornes (µs) des classes de l'histogramme de gigue
+JITTER_BOUNDS_US = (100, 500, 1000, 5000, 20000, 100000)
+
+
+class Scheduler:
+    """
+    Cadence une boucle sur des échéances absolues (time.ticks_us).
+    - L'échéance suivante est calculée depuis la précédente et non depuis
+      la fin de l'échantillon : pas de dérive cumulée de la période.
+    - En cas de dépassement, la politique 'skip' saute les échéances
+      manquées, 'catchup' les rattrape (au plus max_catchup périodes).
+    - Garde des statistiques de gigue (histogramme) et de dépassements.
+    """
+
+    def __init__(self, freq=1, policy=POLICY_SKIP, max_catchup=10):
+        self.policy = policy
+        self.max_catchup = max_catchup
+        self.set_freq(freq)
+        self.deadline = None
+        self.reset_stats()
+
+    def set_freq(self, freq):
+        self.freq = freq
+        self.period_us = int(1000000 / freq)
+
+    def reset_stats(self):
+        self.samples = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitter_max_us = 0
+        self.jitter_sum_us = 0
+        self.jitter_hist = [0] * (len(JITTER_BOUNDS_US) + 1)
+
+    def start(self):
+        """Démarre la grille d'échéances à l'instant présent."""
+        self.deadline = time.ticks_us()
+
+    def remaining_us(self):
+        """Temps restant avant la prochaine échéance (négatif si en retard)."""
+        return time.ticks_diff(self.deadline, time.ticks_us())
+
+    def _sleep_until(self, deadline):
+        remaining = time.ticks_diff(deadline, time.ticks_us())
+        if remaining > 2000:
+            # Sommeil grossier en ms (libère le CPU), puis fin précise en µs
+            time.sleep_ms(remaining // 1000 - 1)
+            remaining = time.ticks_diff(deadline, time.ticks_us())
+        if remaining > 0:
+            time.sleep_us(remaining)
+
+    def _record_jitter(self, late_us):
+        self.samples += 1
+        self.jitter_sum_us += late_us
+        if late_us > self.jitter_max_us:
+            self.jitter_max_us = late_us
+        i = 0
+        for bound in JITTER_BOUNDS_US:
+            if late_us < bound:
+                break
+            i += 1
+        self.jitter_hist[i] += 1
+
+    def wait(self):
+        """
+        Attend la prochaine échéance puis programme la suivante.
+        Retourne le nombre d'échéances sautées (0 si à l'heure).
+        """
+        if self.deadline is None:
+            self.start()
+
+        period = self.period_us
+        deadline = self.deadline
+        late = time.ticks_diff(time.ticks_us(), deadline)
+        skipped = 0
+
+        if late < 0:
+            self._sleep_until(deadline)
+            late = max(0, time.ticks_diff(time.ticks_us(), deadline))
+        elif late >= period:
+            self.overruns += 1
+            if self.policy == POLICY_CATCHUP and late < self.max_catchup * period:
+                pass  # Garde l'échéance : les suivantes s'enchaînent sans attente
+            else:
+                skipped = late // period
+                deadline = time.ticks_add(deadline, skipped * period)
+                late -= skipped * period
+                self.skipped += skipped
+
+        self._record_jitter(late)
+        self.deadline = time.ticks_add(deadline, period)
+        return skipped
+
+    def stats(self):
+        return {
+            'freq': self.freq,
+            'policy': self.policy,
+            'samples': self.samples,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'jitter.max_us': self.jitter_max_us,
+            'jitter.avg_us': self.jitter_sum_us // self.samples if self.samples else 0,
+            'jitter.hist': {
+                f"<{bound}": count for bound, count in zip(JITTER_BOUNDS_US + ('inf',), self.jitter_hist)
+            },
+        }
@@ -2,6 +2,7 @@ from machine import RTC, Pin
 from neopixel import NeoPixel
 import _thread
 import time
+import json
 
 from env import env
 
@@ -55,37 +56,50 @@ def datetime_to_iso_str(year, month, day, hour, minute, second=0, microseconds=0
         date_str += "Z"
     return date_str
 
+def days_from_civil(year, month, day):
+    """Nombre de jours depuis le 1970-01-01 (calendrier grégorien, calcul en O(1))."""
+    year -= 1 if month <= 2 else 0
+    era = year // 400
+    yoe = year - era * 400                                              # [0, 399]
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1  # [0, 365]
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy                       # [0, 146096]
+    return era * 146097 + doe - 719468
+
+def civil_from_days(days):
+    """Inverse de days_from_civil : retourne (year, month, day)."""
+    days += 719468
+    era = days // 146097
+    doe = days - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = mp + (3 if mp < 10 else -9)
+    year = yoe + era * 400 + (1 if month <= 2 else 0)
+    return year, month, day
+
+def datetime_to_epoch_ms(year, month, day, hour=0, minute=0, second=0, microseconds=0):
+    """Convertit une date en millisecondes depuis le 1970-01-01T00:00:00."""
+    days = days_from_civil(year, month, day)
+    return ((days * 24 + hour) * 60 + minute) * 60000 + second * 1000 + microseconds // 1000
+
+def epoch_ms_to_datetime(epoch_ms):
+    """Inverse de datetime_to_epoch_ms : retourne (year, month, day, hour, minute, second, microseconds)."""
+    days, ms = divmod(epoch_ms, 86400000)
+    year, month, day = civil_from_days(days)
+    seconds, ms = divmod(ms, 1000)
+    hour, seconds = divmod(seconds, 3600)
+    minute, second = divmod(seconds, 60)
+    return year, month, day, hour, minute, second, ms * 1000
+
+def epoch_ms_to_iso_str(epoch_ms):
+    return datetime_to_iso_str(*epoch_ms_to_datetime(epoch_ms))
+
 def get_timestamp_from_rtc_datetime():
+    """Date RTC courante en millisecondes depuis le 1970-01-01."""
     rtc = RTC()
     year, month, day, weekday, hour, minute, second, microsecondes = rtc.datetime()
-    
-    days_in_month = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-    
-    # Vérifier si l'année est bissextile
-    if year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
-        days_in_month[1] = 29
-    
-    # Calculer les jours depuis 1970
-    days = 0
-    for y in range(1970, year):
-        days += 366 if (y % 4 == 0 and (y % 100 != 0 or y % 400 == 0)) else 365
-    
-    # Ajouter les jours des mois de l'année courante
-    for m in range(1, month):
-        days += days_in_month[m - 1]
-    
-    # Ajouter les jours du mois courant
-    days += day - 1
-    
-    # Convertir en millisecondes
-    millisecondes = days * 86400 * 1000  # Jours en millisecondes
-    millisecondes += hour * 3600 * 1000  # Heures en millisecondes
-    millisecondes += minute * 60 * 1000  # Minutes en millisecondes
-    millisecondes += second * 1000       # Secondes en millisecondes
-    millisecondes += microsecondes // 1000  # Microsecondes converties en millisecondes (division entière)
-    #print(f"{(year, month, day, weekday, hour, minute, second, microsecondes)} => {timestamp}")
-    
-    return millisecondes
+    return datetime_to_epoch_ms(year, month, day, hour, minute, second, microsecondes)
 
 def get_mime_type(filepath):
     """Retourne le type MIME en fonction de l'extension du fichier."""
@@ -106,6 +120,23 @@ def get_mime_type(filepath):
     return mime_types.get(ext, 'application/octet-stream')
 
 
+def parse_form_urlencoded(body):
+    """Parse un corps 'application/x-www-form-urlencoded' en dict (sans url decode complet)."""
+    data = {}
+    for pair in body.split('&'):
+        if '=' in pair:
+            key, value = pair.split('=', 1)
+            data[key] = value.replace('+', ' ').replace('%2C', ',')
+    return data
+
+
+def parse_int_list(value):
+    """Parse '1,2,3' (ou 1) en liste d'entiers. Retourne None si value est None ou vide."""
+    if value is None or value == '':
+        return None
+    return [int(item) for item in str(value).split(',') if item.strip()]
+
+
 def parse_iso_date_str(date_str):
     """Parse une chaîne date-time 'YYYY-MM-DDTHH:MM:SS[.mmm][Z]' en tuple (year, month, day, hour, minute, second, microseconds).
     Raises ValueError pour formats ou valeurs invalides.
@@ -228,6 +259,19 @@ def format_memory(used, total):
     total_mo = round(total / (1024 * 1024), 1)
     percent = round(100 * used / total, 1)
     return f"{used_mo} Mo / {total_mo} Mo ({percent}%)"
+
+
+def json_array_chunks(items, chunk_size=1024):
+    """Générateur d'un tableau JSON des éléments de items, par morceaux d'environ chunk_size caractères."""
+    chunk = '['
+    separator = ''
+    for item in items:
+        chunk += separator + json.dumps(item)
+        separator = ','
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = ''
+    yield chunk + ']'
     
     
     